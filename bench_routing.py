@@ -0,0 +1,90 @@
+"""Микро-бенчмарк маршрутизации callback-запросов в aiogram.
+
+Измеряет накладные расходы диспетчера на один апдейт при росте числа
+обработчиков для двух схем:
+  flat   — все обработчики на одном Dispatcher с фильтрами F.data == ...
+           (как было в mashina_bot.py до разбиения на роутеры);
+  routed — обработчики разделены на роутеры с предфильтром callback_route
+           (тот же routing.callback_route, что и в боте).
+
+Обработчики ничего не делают и не обращаются к Telegram, поэтому
+измеряется только стоимость поиска обработчика.
+
+Запуск: python bench_routing.py [--updates 2000] [--routers 4]
+"""
+import argparse
+import asyncio
+import time
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.types import CallbackQuery, Update, User
+
+from routing import callback_route
+
+HANDLER_COUNTS = (10, 25, 50, 100, 200)
+
+
+async def noop(callback: CallbackQuery):
+    pass
+
+
+def build_flat(handlers: int) -> Dispatcher:
+    dp = Dispatcher()
+    for i in range(handlers):
+        dp.callback_query.register(noop, F.data == f"cb_{i}")
+    return dp
+
+
+def build_routed(handlers: int, routers: int) -> Dispatcher:
+    dp = Dispatcher()
+    per_router = (handlers + routers - 1) // routers
+    for r in range(routers):
+        names = [f"cb_{i}" for i in range(r * per_router, min(handlers, (r + 1) * per_router))]
+        router = Router(name=f"feature_{r}")
+        router.callback_query.filter(callback_route(exact=names))
+        for name in names:
+            router.callback_query.register(noop, F.data == name)
+        dp.include_router(router)
+    return dp
+
+
+def make_updates(handlers: int, count: int):
+    user = User(id=1, is_bot=False, first_name="Bench")
+    return [
+        Update(update_id=i, callback_query=CallbackQuery(
+            id=str(i), from_user=user, chat_instance="bench", data=f"cb_{i % handlers}"
+        ))
+        for i in range(count)
+    ]
+
+
+async def measure(dp: Dispatcher, bot: Bot, updates) -> float:
+    """Среднее время обработки одного апдейта, мкс."""
+    for update in updates[:100]:  # Прогрев
+        await dp.feed_update(bot, update)
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / len(updates) * 1e6
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--routers", type=int, default=4)
+    args = parser.parse_args()
+
+    bot = Bot(token="123456:BENCHMARK")
+    try:
+        print(f"{'обработчиков':>12} {'flat, мкс':>10} {'routed, мкс':>12}")
+        for handlers in HANDLER_COUNTS:
+            updates = make_updates(handlers, args.updates)
+            flat = await measure(build_flat(handlers), bot, updates)
+            routed = await measure(build_routed(handlers, args.routers), bot, updates)
+            print(f"{handlers:>12} {flat:>10.1f} {routed:>12.1f}")
+    finally:
+        await bot.session.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
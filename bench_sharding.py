@@ -0,0 +1,146 @@
+"""Бенчмарк режима нескольких процессов (BOT_WORKERS) против одного процесса.
+
+Синтетические апдейты Telegram (сообщения и нажатия кнопок) от нескольких
+чатов раздаются процессам теми же функциями, что и в mashina_bot.py:
+update_sharding.shard_index выбирает процесс, process_in_chat_order
+обрабатывает апдейты разных чатов параллельно, одного чата — по порядку.
+Обработчик имитирует CPU-работу бота — сборку текста отчёта и разбиение его
+на страницы, — без обращений к Telegram и таблицам.
+
+Строка «0 процессов» — тот же цикл process_in_chat_order прямо в текущем
+процессе, без очередей между процессами (BOT_WORKERS=0); ускорение считается
+относительно неё. Для каждого варианта проверяется, что порядок апдейтов
+внутри каждого чата не нарушен.
+
+Запуск: python bench_sharding.py [--updates 4000] [--chats 200] [--work 2000]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+from update_sharding import process_in_chat_order, shard_index, update_shard_key
+
+WORKER_COUNTS = (0, 1, 2, 4)
+
+
+def render(chat_id: int, seq: int, work: int) -> int:
+    """CPU-работа одного апдейта: строки «машина: ФИО, остаток» и их разбиение на страницы."""
+    lines = [f"🚙 А{(chat_id + i) % 1000:03d}ВС: Водитель {i}, {seq % 90} л" for i in range(work // 10)]
+    pages, size = 1, 0
+    for line in lines:
+        length = len(line.encode("utf-16-le")) // 2 + 1
+        if size + length > 4096:
+            pages, size = pages + 1, 0
+        size += length
+    return pages
+
+
+def make_update(update_id: int, chat_id: int, seq: int) -> dict:
+    """Апдейт в формате Bot API: каждый третий — нажатие кнопки, остальные — сообщения."""
+    chat = {"id": chat_id, "type": "private"}
+    user = {"id": chat_id, "is_bot": False, "first_name": "Водитель"}
+    if update_id % 3 == 0:
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": str(seq),
+            "message": {"message_id": 1, "date": 0, "chat": chat},
+        }}
+    return {"update_id": update_id, "message": {
+        "message_id": seq + 1, "date": 0, "chat": chat, "from": user, "text": str(seq),
+    }}
+
+
+def update_seq(update: dict) -> int:
+    if "callback_query" in update:
+        return int(update["callback_query"]["data"])
+    return int(update["message"]["text"])
+
+
+async def handle_all(next_update, work: int) -> tuple:
+    """Обрабатывает апдейты циклом бота; возвращает (обработано, нарушений порядка)."""
+    last_seq = {}
+    counts = [0, 0]
+
+    async def handle(update):
+        chat_id, seq = update_shard_key(update), update_seq(update)
+        if seq <= last_seq.get(chat_id, -1):
+            counts[1] += 1
+        last_seq[chat_id] = seq
+        await asyncio.sleep(0)  # Обработчик бота отдаёт управление на каждом await
+        render(chat_id, seq, work)
+        counts[0] += 1
+
+    await process_in_chat_order(next_update, handle)
+    return tuple(counts)
+
+
+def worker(update_queue, result_queue, work: int):
+    result_queue.put(asyncio.run(handle_all(lambda: asyncio.to_thread(update_queue.get), work)))
+
+
+def run_in_process(updates, work: int) -> tuple:
+    """Без процессов-обработчиков: время (сек) и число нарушений порядка."""
+    pending = iter(updates)
+
+    async def next_update():
+        return next(pending, None)
+
+    started = time.perf_counter()
+    _, out_of_order = asyncio.run(handle_all(next_update, work))
+    return time.perf_counter() - started, out_of_order
+
+
+def run(workers: int, updates, work: int) -> tuple:
+    """Время обработки всех апдейтов (сек) и число нарушений порядка."""
+    if not workers:
+        return run_in_process(updates, work)
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=1000) for _ in range(workers)]
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(q, results, work)) for q in queues]
+    for process in processes:
+        process.start()
+
+    # Прогрев: запуск процессов не должен попасть в замер (у служебных чатов отрицательные ID)
+    for index, q in enumerate(queues):
+        q.put(make_update(-1, -1 - index, 0))
+    time.sleep(1)
+
+    started = time.perf_counter()
+    for update in updates:
+        queues[shard_index(update, workers)].put(update)
+    for q in queues:
+        q.put(None)
+    totals = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    return elapsed, sum(out_of_order for _, out_of_order in totals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=4000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--work", type=int, default=2000, help="условная стоимость одного апдейта")
+    args = parser.parse_args()
+
+    # Апдейты чатов перемешаны, как в реальном потоке; seq — номер апдейта внутри чата
+    seqs = {}
+    updates = []
+    for i in range(args.updates):
+        chat_id = (i * 7919) % args.chats + 1
+        seqs[chat_id] = seqs.get(chat_id, -1) + 1
+        updates.append(make_update(i, chat_id, seqs[chat_id]))
+
+    print(f"{'процессов':>10} {'апдейтов/с':>12} {'ускорение':>10} {'нарушений порядка':>18}")
+    baseline = None
+    for workers in WORKER_COUNTS:
+        elapsed, out_of_order = run(workers, updates, args.work)
+        rate = args.updates / elapsed
+        baseline = baseline or rate
+        print(f"{workers:>10} {rate:>12.0f} {rate / baseline:>9.2f}x {out_of_order:>18}")
+
+
+if __name__ == "__main__":
+    main()
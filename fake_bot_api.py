@@ -0,0 +1,90 @@
+"""Локальная заглушка Telegram Bot API для проверки сессии бота без Telegram.
+
+Отвечает на методы так же, как сервер Bot API (формат {"ok": ..., "result": ...}),
+умеет добавлять задержку и случайные временные ошибки (5xx и 429 retry_after),
+чтобы проверить пул соединений, таймауты и повторы. Бот подключается к ней через
+TELEGRAM_API_URL:
+
+    python fake_bot_api.py --port 8081 --latency 50 --fail-rate 0.1
+    TELEGRAM_API_URL=http://localhost:8081 python mashina_bot.py
+
+В конце работы (Ctrl+C) печатает число вызовов по методам.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+
+calls = Counter()
+message_ids = iter(range(1, 10 ** 9))
+
+
+def fake_message(params: dict) -> dict:
+    chat_id = params.get("chat_id", 0)
+    return {
+        "message_id": int(params.get("message_id") or next(message_ids)),
+        "date": int(time.time()),
+        "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else 0, "type": "private"},
+        "from": BOT_USER,
+        "text": params.get("text", ""),
+    }
+
+
+async def handle(request: web.Request):
+    args = request.app["args"]
+    method = request.match_info["method"]
+    params = dict(await request.post()) if request.can_read_body else {}
+    params.update(request.query)
+    calls[method] += 1
+
+    if method.lower() == "getupdates":
+        # Long polling: апдейтов нет, держим соединение до таймаута
+        await asyncio.sleep(min(float(params.get("timeout", 0) or 0), args.poll_wait))
+        return web.json_response({"ok": True, "result": []})
+
+    await asyncio.sleep(args.latency / 1000)
+    roll = random.random()
+    if roll < args.fail_rate / 2:
+        calls[f"{method}:500"] += 1
+        return web.json_response({"ok": False, "error_code": 500, "description": "Internal Server Error"}, status=500)
+    if roll < args.fail_rate:
+        calls[f"{method}:429"] += 1
+        return web.json_response({
+            "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+            "parameters": {"retry_after": 1},
+        }, status=429)
+
+    if method.lower() == "getme":
+        result = BOT_USER
+    elif method.lower() in ("sendmessage", "editmessagetext", "senddocument"):
+        result = fake_message(params)
+    else:
+        result = True
+    return web.json_response({"ok": True, "result": result})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0, help="задержка ответа, мс")
+    parser.add_argument("--fail-rate", type=float, default=0, help="доля ответов 500/429")
+    parser.add_argument("--poll-wait", type=float, default=5, help="сколько держать getUpdates, сек")
+    args = parser.parse_args()
+
+    app = web.Application()
+    app["args"] = args
+    app.router.add_route("*", "/bot{token}/{method}", handle)
+    try:
+        web.run_app(app, port=args.port)
+    finally:
+        for method, count in sorted(calls.items()):
+            print(f"{method:>30} {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Векторная аналитика расхода топлива по журналу «Изменения».
+
+Журнал загружается в столбцы NumPy прямо из отсортированной выборки индекса
+(log_from_sorted), после чего расход, заправки, нарастающие итоги и расхождения
+с остатком, внесённым админом, считаются целиком на массивах — без циклов
+Python по строкам.
+
+Модуль не зависит от бота и Google Sheets, поэтому его функции можно
+выполнять и в отдельных процессах: журнал передаётся туда через общую
+память (share_log), без сериализации массивов.
+"""
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+@dataclass
+class FuelLog:
+    """Журнал показаний в столбцах, отсортированный по машине и времени."""
+    cars: np.ndarray  # уникальные номера машин; car_codes — индексы в этом массиве
+    car_codes: np.ndarray  # int32
+    ts: np.ndarray  # datetime64[s]
+    stock: np.ndarray  # float64, литры
+
+    def __len__(self):
+        return len(self.stock)
+
+
+def log_from_sorted(rows) -> FuelLog:
+    """Строит FuelLog из строк (машина, unix-время, остаток), уже отсортированных
+    по машине и времени — например, выборки SQLite с ORDER BY car, ts."""
+    rows = list(rows)
+    if not rows:
+        return FuelLog(cars=np.array([], dtype=object), car_codes=np.array([], dtype=np.int32),
+                       ts=np.array([], dtype="datetime64[s]"), stock=np.array([]))
+    car_column, ts_column, stock_column = zip(*rows)
+    car_column = np.array(car_column, dtype=object)
+    changed = np.ones(len(rows), dtype=bool)
+    changed[1:] = car_column[1:] != car_column[:-1]
+    return FuelLog(
+        cars=car_column[changed],
+        car_codes=(np.cumsum(changed) - 1).astype(np.int32),
+        ts=np.array(ts_column, dtype=np.int64).astype("datetime64[s]"),
+        stock=np.array(stock_column, dtype=np.float64),
+    )
+
+
+# Столбцы FuelLog в общей памяти: (поле, тип), подряд друг за другом
+_SHARED_COLUMNS = (("car_codes", np.int32), ("ts", np.int64), ("stock", np.float64))
+
+
+def share_log(log: FuelLog):
+    """Копирует столбцы журнала в общую память.
+
+    Возвращает (SharedMemory, handle): handle — маленький словарь, который
+    передаётся в процесс вместо массивов. Вызывающий закрывает и удаляет
+    SharedMemory (close + unlink), когда процесс вернул результат.
+    """
+    size = len(log)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, size * sum(np.dtype(t).itemsize for _, t in _SHARED_COLUMNS)))
+    offset = 0
+    for field, dtype in _SHARED_COLUMNS:
+        column = np.ndarray(size, dtype=dtype, buffer=shm.buf, offset=offset)
+        column[:] = getattr(log, field).view(np.int64) if field == "ts" else getattr(log, field)
+        offset += column.nbytes
+    del column  # Представления должны быть освобождены до shm.close()
+    return shm, {"name": shm.name, "size": size, "cars": list(log.cars)}
+
+
+def _attach(name: str):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def summary_from_shared(handle: dict, admin_stock: dict):
+    """car_summary по журналу из общей памяти (выполняется в процессе пула)."""
+    shm = _attach(handle["name"])
+    try:
+        size, offset, columns = handle["size"], 0, {}
+        for field, dtype in _SHARED_COLUMNS:
+            columns[field] = np.ndarray(size, dtype=dtype, buffer=shm.buf, offset=offset)
+            offset += columns[field].nbytes
+        log = FuelLog(cars=np.array(handle["cars"], dtype=object), car_codes=columns["car_codes"],
+                      ts=columns["ts"].view("datetime64[s]"), stock=columns["stock"])
+        # Индексирование и арифметика возвращают новые массивы — результат не ссылается на shm
+        summary = car_summary(log, admin_stock)
+        del log, columns
+        return summary
+    finally:
+        shm.close()
+
+
+def consumption_deltas(log: FuelLog):
+    """Изменение остатка относительно предыдущего показания той же машины.
+
+    Возвращает (delta, first): delta — NaN для первого показания машины,
+    first — маска первых показаний.
+    """
+    first = np.ones(len(log), dtype=bool)
+    first[1:] = log.car_codes[1:] != log.car_codes[:-1]
+    delta = np.empty(len(log))
+    delta[0:1] = np.nan
+    delta[1:] = np.diff(log.stock)
+    delta[first] = np.nan
+    return delta, first
+
+
+def running_consumption(log: FuelLog, start: dict = None):
+    """Нарастающий итог израсходованного топлива по каждой машине на момент каждого показания.
+
+    start — {номер машины: (остаток, израсходовано)} до первого показания журнала:
+    с ним первое показание машины считается от прежнего остатка, а итог продолжает
+    прежний, так что длинный журнал можно обрабатывать кусками. Без start итог
+    каждой машины начинается с нуля.
+    """
+    if not len(log):
+        return np.array([])
+    delta, first = consumption_deltas(log)
+    starts = np.flatnonzero(first)
+    carried = np.zeros(len(starts))
+    if start:
+        for group, index in enumerate(starts):
+            previous = start.get(log.cars[log.car_codes[index]])
+            if previous is not None:
+                delta[index] = log.stock[index] - previous[0]
+                carried[group] = previous[1]
+    consumed = np.where(delta < 0, -delta, 0.0)
+    total = np.cumsum(consumed)
+    counts = np.diff(np.append(starts, len(log)))
+    return total - np.repeat(total[starts] - consumed[starts] - carried, counts)
+
+
+def car_summary(log: FuelLog, admin_stock: dict):
+    """Сводка по машинам.
+
+    admin_stock — {номер машины: остаток, внесённый админом}. Возвращает словарь
+    столбцов: car, readings, consumed, refilled, last_stock, last_ts, admin_stock,
+    discrepancy (остаток админа минус последнее показание водителя).
+    """
+    if not len(log):
+        return {key: np.array([]) for key in
+                ("car", "readings", "consumed", "refilled", "last_stock", "last_ts", "admin_stock", "discrepancy")}
+
+    delta, first = consumption_deltas(log)
+    consumed = np.where(delta < 0, -delta, 0.0)
+    refilled = np.where(delta > 0, delta, 0.0)
+
+    starts = np.flatnonzero(first)
+    lasts = np.append(starts[1:] - 1, len(log) - 1)
+    codes = log.car_codes[starts]
+    cars = log.cars[codes]
+
+    admin = np.array([admin_stock.get(car, np.nan) for car in cars], dtype=np.float64)
+    last_stock = log.stock[lasts]
+    return {
+        "car": cars,
+        "readings": np.diff(np.append(starts, len(log))),
+        "consumed": np.add.reduceat(consumed, starts),
+        "refilled": np.add.reduceat(refilled, starts),
+        "last_stock": last_stock,
+        "last_ts": log.ts[lasts],
+        "admin_stock": admin,
+        "discrepancy": admin - last_stock,
+    }
+
+
+class StockAnomalyDetector:
+    """Потоковый детектор подозрительных показаний остатка.
+
+    Для каждой машины в памяти хранятся последнее показание и EWMA расхода
+    (л/ч). Показание считается аномальным, если оно вне объёма бака или если
+    остаток упал намного сильнее обычного расхода за прошедшее время.
+    """
+
+    def __init__(self, capacity: float = 100.0, factor: float = 3.0, min_liters: float = 10.0,
+                 alpha: float = 0.3, warmup: int = 3):
+        self.capacity = capacity  # объём бака, л
+        self.factor = factor  # во сколько раз падение может превысить обычный расход
+        self.min_liters = min_liters  # падения меньше этого не считаются аномалией
+        self.alpha = alpha  # вес нового значения в EWMA
+        self.warmup = warmup  # сколько замеров расхода нужно, прежде чем сравнивать
+        self.cars = {}  # номер -> [время, остаток, EWMA л/ч или None, число замеров расхода]
+
+    def check(self, car: str, ts, stock: float):
+        """Проверяет показание и учитывает его в статистике машины.
+
+        ts — datetime. Возвращает список причин, по которым показание подозрительно
+        (пустой, если всё в порядке). Показания не новее последнего учтённого
+        пропускаются — так повторная загрузка журнала не искажает статистику.
+        """
+        reasons = []
+        if not 0 <= stock <= self.capacity:
+            reasons.append(f"показание {stock:g} л вне объёма бака 0–{self.capacity:g} л")
+
+        state = self.cars.get(car)
+        if state is None:
+            self.cars[car] = [ts, stock, None, 0]
+            return reasons
+
+        last_ts, last_stock, rate, samples = state
+        if ts <= last_ts:
+            return []
+
+        hours = max((ts - last_ts).total_seconds() / 3600, 0.25)
+        drop = last_stock - stock
+        if drop > 0:
+            expected = (rate or 0.0) * hours
+            if samples >= self.warmup and drop > max(self.min_liters, self.factor * expected):
+                reasons.append(f"остаток упал на {drop:g} л за {hours:.1f} ч, обычно — {expected:.1f} л")
+            elif not reasons:
+                # Аномальные замеры не портят EWMA
+                rate = drop / hours if rate is None else self.alpha * drop / hours + (1 - self.alpha) * rate
+                samples += 1
+
+        self.cars[car] = [ts, stock, rate, samples]
+        return reasons
@@ -1,23 +1,234 @@
+import asyncio
+import atexit
+import bisect
+import contextlib
+import contextvars
+import cProfile
+import csv
 import logging
+import multiprocessing
 import os
 import datetime
+import itertools
+import json
+import pstats
+import queue
+import random
 import re
-import gspread
+import signal
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging.handlers import QueueHandler, QueueListener
 
-from aiogram import Bot, Dispatcher, F
-from aiogram.filters import Command
+import gspread
+import numpy as np
+import pytz
+from aiohttp import web
+from cachetools import LRUCache, TTLCache
+
+from aiogram import Bot, Dispatcher, F, Router, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from aiogram.types import InlineQuery, InlineQueryResultArticle, InputTextMessageContent, FSInputFile
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials
 
+import fuel_analytics
+from sheet_store import CarIndex, RowMoved, SheetsOutbox, UserIndex, checked_row_update, checked_rows_update
+from routing import callback_route
+from update_sharding import process_in_chat_order, shard_index
+
 
 
 # ==================== НАСТРОЙКИ ====================
-logging.basicConfig(level=logging.DEBUG)
 load_dotenv()
 
+# ==================== ЛОГИРОВАНИЕ ====================
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Доля сохраняемых записей частых событий (aiogram.event пишет строку на каждый апдейт)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+SAMPLED_LOGGERS = ("aiogram.event",)
+
+# ID апдейта Telegram, в рамках которого сделана запись
+correlation_id = contextvars.ContextVar("correlation_id", default=None)
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None) is not None:
+            entry["update_id"] = record.correlation_id
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class ContextFilter(logging.Filter):
+    """Добавляет correlation ID и отбрасывает часть записей частых событий.
+
+    Предупреждения и ошибки не отбрасываются никогда. Запись можно явно пометить
+    частой: logging.info(..., extra={"sampled": True}).
+    """
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        if record.levelno < logging.WARNING and (record.name.startswith(SAMPLED_LOGGERS) or getattr(record, "sampled", False)):
+            return random.random() < LOG_SAMPLE_RATE
+        return True
+
+
+def setup_logging():
+    """Записи форматируются в вызывающем потоке, а в stdout пишет отдельный поток,
+    поэтому логирование не блокирует цикл событий на вводе-выводе."""
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.setFormatter(JsonFormatter())
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)
+
+
+setup_logging()
+
+# ==================== ТРАССИРОВКА ====================
+# Куда выгружать span'ы: console, file или пусто — трассировка выключена
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+# Доля апдейтов (корневых span'ов), которые трассируются
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+# Текущий span; NOT_SAMPLED — корневой span не попал в выборку, дочерние не создаются
+current_span = contextvars.ContextVar("current_span", default=None)
+NOT_SAMPLED = object()
+trace_log = logging.getLogger("tracing")
+
+
+class Span:
+    """Span в духе OpenTelemetry: trace_id общий для дерева, parent_id — родитель."""
+
+    def __init__(self, name: str, parent, attributes: dict):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.status = "ok"
+        self.start = time.time()
+        self._started = time.perf_counter()
+
+    def end(self):
+        trace_log.info(json.dumps({
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((time.perf_counter() - self._started) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }, ensure_ascii=False, default=str))
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """Открывает дочерний span текущего (или корневой, если текущего нет)."""
+    parent = current_span.get()
+    if not TRACE_EXPORTER or parent is NOT_SAMPLED:
+        yield None
+        return
+    if parent is None and random.random() >= TRACE_SAMPLE_RATE:
+        token = current_span.set(NOT_SAMPLED)
+        try:
+            yield None
+        finally:
+            current_span.reset(token)
+        return
+
+    current = Span(name, parent, attributes)
+    token = current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes["error"] = repr(e)
+        raise
+    finally:
+        current_span.reset(token)
+        current.end()
+
+
+def setup_tracing():
+    """Span'ы пишутся отдельным потоком, как и журнал, — в файл или в консоль."""
+    if not TRACE_EXPORTER:
+        return
+    trace_queue = queue.SimpleQueue()
+    trace_log.handlers[:] = [QueueHandler(trace_queue)]
+    trace_log.setLevel(logging.INFO)
+    trace_log.propagate = False
+    target = logging.FileHandler(TRACE_FILE, encoding="utf-8") if TRACE_EXPORTER == "file" else logging.StreamHandler()
+    listener = QueueListener(trace_queue, target)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+setup_tracing()
+
+
+class TracedWorksheet:
+    """Обёртка листа gspread: каждый вызов метода оформляется дочерним span'ом."""
+
+    def __init__(self, worksheet):
+        self._worksheet = worksheet
+
+    def __getattr__(self, name):
+        attr = getattr(self._worksheet, name)
+        if not callable(attr):
+            return attr
+
+        def traced(*args, **kwargs):
+            with span(f"gspread.{name}", worksheet=self._worksheet.title):
+                return attr(*args, **kwargs)
+
+        return traced
+
+
+class TraceRequestMiddleware(BaseRequestMiddleware):
+    """Span на каждый вызов Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        with span(f"telegram.{type(method).__name__}"):
+            return await make_request(bot, method)
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")  # Вставь ID своей Google таблицы
 
@@ -42,8 +253,121 @@ async def update_admin_ids():
     global ADMIN_IDS
     ADMIN_IDS = load_admin_ids()
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher()
+# ==================== СЕССИЯ BOT API ====================
+# Размер пула соединений к Bot API: не меньше BROADCAST_CONCURRENCY + long polling
+BOT_POOL_SIZE = int(os.getenv("BOT_POOL_SIZE", "100"))
+# Сколько держать простаивающее соединение открытым (сек)
+BOT_KEEPALIVE = float(os.getenv("BOT_KEEPALIVE", "60"))
+# Сколько кэшировать DNS-ответ для api.telegram.org (сек)
+BOT_DNS_TTL = int(os.getenv("BOT_DNS_TTL", "3600"))
+# Таймаут одного запроса к Bot API (сек); для getUpdates к нему добавляется время long polling
+# (dp.start_polling делает это сам, run_supervisor — явно через request_timeout)
+BOT_REQUEST_TIMEOUT = float(os.getenv("BOT_REQUEST_TIMEOUT", "30"))
+BOT_RETRIES = int(os.getenv("BOT_RETRIES", "3"))
+# Дольше этого RetryAfter не ждём в сессии — решает вызывающий код (сек)
+BOT_RETRY_MAX_WAIT = float(os.getenv("BOT_RETRY_MAX_WAIT", "30"))
+# Адрес локального сервера Bot API (telegram-bot-api --local), например http://localhost:8081
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+TELEGRAM_API_LOCAL = os.getenv("TELEGRAM_API_LOCAL", "1") == "1"
+
+# Методы, повтор которых после сетевой ошибки безопасен: они не создают новых сообщений
+IDEMPOTENT_METHOD_PREFIXES = ("Get", "Edit", "Delete", "Answer", "Set")
+
+
+class TunedAiohttpSession(AiohttpSession):
+    """AiohttpSession с настраиваемыми keep-alive и кэшем DNS для пула соединений."""
+
+    def __init__(self, keepalive_timeout: float, ttl_dns_cache: int, **kwargs):
+        super().__init__(**kwargs)
+        # Параметры TCPConnector, с которыми AiohttpSession создаёт пул при первом запросе
+        self._connector_init.update(keepalive_timeout=keepalive_timeout, ttl_dns_cache=ttl_dns_cache)
+
+
+class RetryRequestMiddleware(BaseRequestMiddleware):
+    """Повторяет вызовы Bot API при временных ошибках.
+
+    RetryAfter повторяется всегда (Telegram запрос не выполнил), сетевые и 5xx
+    ошибки — только для идемпотентных методов: отправку сообщения после обрыва
+    повторять нельзя, оно могло дойти. getUpdates повторяет сам диспетчер.
+    """
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        for attempt in range(BOT_RETRIES + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == BOT_RETRIES or e.retry_after > BOT_RETRY_MAX_WAIT:
+                    raise
+                delay = e.retry_after
+            except (TelegramNetworkError, TelegramServerError):
+                if attempt == BOT_RETRIES or name == "GetUpdates" or not name.startswith(IDEMPOTENT_METHOD_PREFIXES):
+                    raise
+                delay = min(2 ** attempt, 10) * random.uniform(0.5, 1.5)  # Экспонента с разбросом
+            METRICS[f"bot_api_retry_{name}"] += 1
+            await asyncio.sleep(delay)
+
+
+bot_session = TunedAiohttpSession(
+    limit=BOT_POOL_SIZE,
+    keepalive_timeout=BOT_KEEPALIVE,
+    ttl_dns_cache=BOT_DNS_TTL,
+    timeout=BOT_REQUEST_TIMEOUT,
+    api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL) if TELEGRAM_API_URL else PRODUCTION,
+)
+# Повторы снаружи трассировки: каждая попытка — отдельный span
+bot_session.middleware(RetryRequestMiddleware())
+bot_session.middleware(TraceRequestMiddleware())
+bot = Bot(token=BOT_TOKEN, session=bot_session)
+# Общее хранилище состояний FSM для нескольких процессов или перезапусков; без него — в памяти
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    fsm_storage = RedisStorage.from_url(REDIS_URL)
+else:
+    fsm_storage = MemoryStorage()
+dp = Dispatcher(storage=fsm_storage)
+# Обработчики разделены по разделам, роутеры подключаются к dp в конце файла
+registration_router = Router(name="registration")
+driver_router = Router(name="driver")
+admin_router = Router(name="admin")
+
+
+# ==================== ПОВТОРНЫЕ АПДЕЙТЫ ====================
+# Telegram может прислать апдейт повторно (переподключение, ретрай вебхука); update_id уникален
+seen_update_ids = TTLCache(maxsize=20000, ttl=int(os.getenv("UPDATE_DEDUP_TTL", "600")))
+# Одинаковые показания (водитель, машина, литры) в пределах минуты — двойная отправка
+recent_stock_submissions = TTLCache(maxsize=10000, ttl=60)
+# Заявки, поставленные в очередь записей, но, возможно, ещё не попавшие в таблицу
+recent_registrations = TTLCache(maxsize=10000, ttl=3600)
+
+
+@dp.update.outer_middleware()
+async def drop_duplicate_updates(handler, event: types.Update, data):
+    """Отбрасывает апдейт, уже полученный ранее, до всех обработчиков и записей в таблицы."""
+    if event.update_id in seen_update_ids:
+        METRICS["duplicate_updates"] += 1
+        logging.info(f"Повторный апдейт {event.update_id} пропущен")
+        return None
+    seen_update_ids[event.update_id] = True
+    return await handler(event, data)
+
+
+@dp.update.outer_middleware()
+async def bind_correlation_id(handler, event: types.Update, data):
+    """Связывает все записи журнала, сделанные при обработке апдейта, с его update_id."""
+    token = correlation_id.set(event.update_id)
+    try:
+        return await handler(event, data)
+    finally:
+        correlation_id.reset(token)
+
+
+@dp.update.outer_middleware()
+async def trace_update(handler, event: types.Update, data):
+    """Корневой span на каждый апдейт; вызовы таблиц и Bot API становятся дочерними."""
+    with span("update", update_id=event.update_id, event_type=event.event_type):
+        return await handler(event, data)
 # Количество машин на одной странице
 CARS_PER_PAGE = 5
 # Настройка Google Sheets
@@ -51,12 +375,544 @@ scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/au
          "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
 creds = ServiceAccountCredentials.from_json_keyfile_name("credentials.json", scope)
 client = gspread.authorize(creds)
-sheet = client.open_by_key(SPREADSHEET_ID).sheet1  # Работаем с первым листом
-cars_sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Состояние машины")
-changes_sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Изменения")
+spreadsheet = client.open_by_key(SPREADSHEET_ID)
+sheet = TracedWorksheet(spreadsheet.sheet1)  # Работаем с первым листом
+cars_sheet = TracedWorksheet(spreadsheet.worksheet("Состояние машины"))
+changes_sheet = TracedWorksheet(spreadsheet.worksheet("Изменения"))
 # Регулярное выражение для проверки номера телефона
 PHONE_REGEX = r"^\+7\d{10}$"
 
+# ==================== КЭШ ТАБЛИЦ ====================
+# Сколько секунд данные листа считаются актуальными
+SHEET_CACHE_TTL = float(os.getenv("SHEET_CACHE_TTL", "60"))
+USER_MISS_REREAD = 5  # Не чаще раза в N секунд перечитывать пользователей из-за промаха
+
+# Счётчики бота, которые отдаёт /metrics: доставка (<metric>_sent, <metric>_failed,
+# <metric>_timeout, <metric>_seconds), очередь записей, кэши отчётов
+METRICS = Counter()
+
+user_index = UserIndex(sheet, SHEET_CACHE_TTL)
+car_index = CarIndex(cars_sheet, SHEET_CACHE_TTL)
+
+
+# ==================== ИНДЕКС ЗАПРАВОК ====================
+FUEL_INDEX_DB = os.getenv("FUEL_INDEX_DB", "fuel_index.db")
+# Как часто догружать строки, добавленные в «Изменения» вручную (сек)
+FUEL_SYNC_INTERVAL = int(os.getenv("FUEL_SYNC_INTERVAL", "300"))
+
+
+class FuelIndex:
+    """Локальный SQLite-индекс записей листа «Изменения» по машине, водителю и дате.
+
+    Строки листа хранятся под своими номерами, поэтому индекс пополняется
+    инкрементально: при записи из бота и догрузкой строк после последней
+    синхронизированной. Граница синхронизации хранится отдельно: строки, внесённые
+    вручную между записями бота, не пропускаются. Если строки листа сдвинулись
+    (строку выше границы удалили или вставили вручную), sync замечает это по
+    последней синхронизированной строке и перестраивает индекс целиком.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                row INTEGER PRIMARY KEY,  -- номер строки в листе «Изменения»
+                name TEXT,
+                phone TEXT,
+                car TEXT,
+                stock REAL,
+                ts TEXT  -- ГГГГ-ММ-ДД ЧЧ:ММ:СС, сортируется как строка
+            );
+            CREATE INDEX IF NOT EXISTS entries_car ON entries (car, ts);
+            CREATE INDEX IF NOT EXISTS entries_phone ON entries (phone, ts);
+            CREATE INDEX IF NOT EXISTS entries_ts ON entries (ts);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER);
+        """)
+
+    def next_row(self) -> int:
+        """Номер первой строки листа после синхронизированных."""
+        synced = self.db.execute("SELECT value FROM meta WHERE key = 'synced_row'").fetchone()
+        return (synced[0] if synced else 1) + 1
+
+    @staticmethod
+    def parse_row(row_number: int, row):
+        """Запись индекса (строка, ФИО, телефон, машина, остаток, время) или None для строки без машины."""
+        name, phone, car, stock, ts = (list(row) + [""] * 5)[:5]
+        if not car:
+            return None
+        try:
+            stock = float(str(stock).replace(",", "."))
+        except ValueError:
+            stock = None
+        return row_number, name, phone, car, stock, ts
+
+    def last_row(self) -> int:
+        """Номер последней проиндексированной строки (0 — индекс пуст)."""
+        return self.db.execute("SELECT COALESCE(MAX(row), 0) FROM entries").fetchone()[0]
+
+    def row_matches(self, row_number: int, row) -> bool:
+        """Совпадает ли строка листа с проиндексированной под тем же номером."""
+        stored = self.db.execute("SELECT * FROM entries WHERE row = ?", (row_number,)).fetchone()
+        return stored == (self.parse_row(row_number, row) if row is not None else None)
+
+    def add_rows(self, first_row: int, rows, synced: bool = False, indexed_before: int = None):
+        """Добавляет строки листа, начиная с номера first_row.
+
+        synced=True — строки получены синхронизацией подряд до конца листа: граница
+        сдвигается, а записи под номерами после последней строки удаляются — их
+        строки сдвинулись или удалены. indexed_before — last_row() до начала чтения
+        листа: записи дальше него бот добавил, пока лист читался, и они остаются
+        (следующая синхронизация их перечитает).
+        """
+        records = [
+            record for record in (self.parse_row(n, row) for n, row in enumerate(rows, start=first_row)) if record
+        ]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)", records)
+            if synced:
+                last_row = first_row + len(rows) - 1
+                if indexed_before is None:
+                    self.db.execute("DELETE FROM entries WHERE row > ?", (last_row,))
+                else:
+                    self.db.execute("DELETE FROM entries WHERE row > ? AND row <= ?", (last_row, indexed_before))
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('synced_row', ?)", (max(last_row, 1),))
+
+    def rebuild(self, rows, indexed_before: int = None):
+        """Заменяет индекс строками листа со второй (после заголовка).
+
+        indexed_before — как в add_rows: записи, добавленные ботом во время чтения листа, сохраняются.
+        """
+        with self.db:
+            if indexed_before is None:
+                self.db.execute("DELETE FROM entries")
+            else:
+                self.db.execute("DELETE FROM entries WHERE row <= ?", (indexed_before,))
+            self.db.execute("DELETE FROM meta WHERE key = 'synced_row'")
+        self.add_rows(2, rows, synced=True, indexed_before=indexed_before)
+
+    def add_appended(self, response: dict, values: list):
+        """Индексирует строку по ответу append_row; если номер строки неизвестен — догрузит sync."""
+        match = re.search(r"![A-Z]+(\d+)", response.get("updates", {}).get("updatedRange", ""))
+        if match:
+            self.add_rows(int(match.group(1)), [values])
+
+    def car_history(self, car: str, limit: int = 10):
+        """Последние limit показаний по машине, новые первыми."""
+        return self.db.execute(
+            "SELECT ts, name, stock FROM entries WHERE car = ? ORDER BY ts DESC LIMIT ?", (car, limit)
+        ).fetchall()
+
+    def driver_entries(self, phone: str, since: str):
+        """Записи водителя (по телефону) начиная с даты since."""
+        return self.db.execute(
+            "SELECT ts, car, stock FROM entries WHERE phone = ? AND ts >= ? ORDER BY ts", (phone, since)
+        ).fetchall()
+
+    def entries_between(self, since: str, until: str):
+        """(машина, время, остаток) всех показаний в интервале [since, until)."""
+        return self.db.execute(
+            "SELECT car, ts, stock FROM entries WHERE ts >= ? AND ts < ? AND stock IS NOT NULL ORDER BY ts", (since, until)
+        ).fetchall()
+
+    def iter_entries(self, since: str, until: str):
+        """Построчно отдаёт (время, ФИО, телефон, машина, остаток) за [since, until) по времени.
+
+        Читает через отдельное соединение, поэтому безопасен в asyncio.to_thread
+        и не держит выборку в памяти целиком.
+        """
+        db = sqlite3.connect(self.path)
+        try:
+            yield from db.execute(
+                "SELECT ts, name, phone, car, stock FROM entries WHERE ts >= ? AND ts < ? ORDER BY ts", (since, until)
+            )
+        finally:
+            db.close()
+
+    def fuel_log(self, since: str, until: str):
+        """Показания за [since, until) сразу в столбцах fuel_analytics.FuelLog.
+
+        Даты разбирает SQLite, сортировку по машине и времени даёт индекс entries_car.
+        Читает через отдельное соединение — безопасен в asyncio.to_thread.
+        """
+        db = sqlite3.connect(self.path)
+        try:
+            return fuel_analytics.log_from_sorted(db.execute(
+                "SELECT car, CAST(strftime('%s', ts) AS INTEGER), stock FROM entries "
+                "WHERE ts >= ? AND ts < ? AND stock IS NOT NULL AND strftime('%s', ts) IS NOT NULL ORDER BY car, ts",
+                (since, until)
+            ))
+        finally:
+            db.close()
+
+    def version(self):
+        """Меняется при любой записи в индекс — из этого процесса или из другого."""
+        return self.db.total_changes, self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def phones_since(self, since: str):
+        """Телефоны водителей, вносивших остаток начиная с даты since."""
+        return {phone for (phone,) in self.db.execute("SELECT DISTINCT phone FROM entries WHERE ts >= ?", (since,))}
+
+
+fuel_index = FuelIndex(FUEL_INDEX_DB)
+
+# ==================== КОНТРОЛЬ ПОКАЗАНИЙ ====================
+TANK_CAPACITY = float(os.getenv("TANK_CAPACITY", "100"))
+# Падение остатка больше ANOMALY_FACTOR обычных расходов (и не меньше ANOMALY_MIN_LITERS) — аномалия
+ANOMALY_FACTOR = float(os.getenv("ANOMALY_FACTOR", "3"))
+ANOMALY_MIN_LITERS = float(os.getenv("ANOMALY_MIN_LITERS", "10"))
+# За сколько дней истории восстанавливать статистику при запуске
+ANOMALY_HISTORY_DAYS = 30
+
+anomaly_detector = fuel_analytics.StockAnomalyDetector(
+    capacity=TANK_CAPACITY, factor=ANOMALY_FACTOR, min_liters=ANOMALY_MIN_LITERS
+)
+
+
+def observe_fuel_entries(entries):
+    """Учитывает в статистике детектора показания (машина, "ГГГГ-ММ-ДД ЧЧ:ММ:СС", остаток)."""
+    for car, ts, stock in entries:
+        try:
+            anomaly_detector.check(car, datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S"), float(stock))
+        except (TypeError, ValueError):
+            continue
+
+
+def check_stock_reading(values: list):
+    """Проверяет показание [ФИО, телефон, машина, остаток, время], поставленное в очередь
+    записи в «Изменения»; о подозрительном фоном сообщает админам.
+
+    Вызывается из watch_stock_readings в основном процессе — поэтому при BOT_WORKERS > 1
+    детектор один и видит показания всех чатов, а строки, внесённые вручную,
+    он получает из sync_fuel_index_periodically.
+    """
+    full_name, phone_number, car, stock, ts = values
+    try:
+        reasons = anomaly_detector.check(car, datetime.datetime.strptime(ts, "%Y-%m-%d %H:%M:%S"), float(stock))
+    except (TypeError, ValueError):
+        return
+    if reasons:
+        METRICS["stock_anomalies"] += 1
+        run_in_background(notify_admins(
+            f"⚠️ Подозрительное показание остатка\n\n"
+            f"👤 ФИО: {full_name}\n📞 Телефон: {phone_number}\n🚙 Машина: {car}\n⛽️ Остаток: {stock} л\n\n"
+            + "\n".join(f"• {reason}" for reason in reasons)
+        ))
+
+
+def seed_anomaly_detector():
+    """Восстанавливает статистику по машинам из локального индекса — без запросов к таблице."""
+    since = (datetime.date.today() - datetime.timedelta(days=ANOMALY_HISTORY_DAYS)).isoformat()
+    observe_fuel_entries(fuel_index.entries_between(since, "9999"))
+
+
+async def sync_fuel_index_periodically():
+    """Догружает строки, появившиеся в листе после последней проиндексированной
+    (при первом запуске — весь лист).
+
+    Чтение начинается с последней синхронизированной строки: если она не совпадает
+    с индексом, строки листа сдвинулись, и индекс перестраивается по всему листу.
+    Строки, которые очередь записей добавила в индекс, пока лист читался, в
+    прочитанное не попали — их не удаляем (indexed_before).
+    """
+    while True:
+        try:
+            first_row = fuel_index.next_row()
+            last_synced = first_row - 1
+            indexed_before = fuel_index.last_row()
+            rows = await asyncio.to_thread(changes_sheet.get, f"A{max(last_synced, 2)}:E")
+            if last_synced >= 2 and not fuel_index.row_matches(last_synced, rows[0] if rows else None):
+                indexed_before = fuel_index.last_row()
+                all_rows = await asyncio.to_thread(changes_sheet.get, "A2:E")
+                fuel_index.rebuild(all_rows, indexed_before)
+                logging.warning(f"Индекс заправок: строки листа сдвинулись, индекс перестроен ({len(all_rows)} строк)")
+                added = []
+            else:
+                added = rows[1:] if last_synced >= 2 else rows
+                fuel_index.add_rows(first_row, added, synced=True, indexed_before=indexed_before)
+            if added:
+                observe_fuel_entries(
+                    (row[2], row[4], str(row[3]).replace(",", ".")) for row in added if len(row) >= 5
+                )
+                logging.info(f"Индекс заправок: добавлено строк {len(added)}")
+        except Exception as e:
+            logging.error(f"Ошибка синхронизации индекса заправок: {e}")
+        await asyncio.sleep(FUEL_SYNC_INTERVAL)
+
+
+# ==================== ОЧЕРЕДЬ ЗАПИСЕЙ В ТАБЛИЦЫ ====================
+OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.db")
+# Сколько попыток применить операцию, прежде чем отложить её как ошибочную
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Сколько хранить применённые операции — столько же работают ключи идемпотентности (ч)
+OUTBOX_RETENTION_HOURS = float(os.getenv("OUTBOX_RETENTION_HOURS", "72"))
+# Как часто проверять операции, поставленные другими процессами (сек)
+OUTBOX_POLL_INTERVAL = 1.0
+
+# Сколько раз искать заново сдвинутые строки пакетной записи заявок
+BULK_ROW_ATTEMPTS = 3
+
+# Листы, в которые пишет очередь
+OUTBOX_SHEETS = {"users": sheet, "cars": cars_sheet, "changes": changes_sheet}
+# batchUpdate всей таблицы для записи с проверкой адреса — с span'ами, как и листы
+traced_spreadsheet = TracedWorksheet(spreadsheet)
+
+sheets_outbox = SheetsOutbox(OUTBOX_DB, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_HOURS, METRICS)
+
+
+def locate_car(car_number: str):
+    """(номер строки, строка) машины по карте строк каталога — без чтения листа."""
+    car_index.loaded_rows()
+    return car_index.by_number.get(car_number)
+
+
+def locate_user(telegram_id):
+    """(номер строки, строка) пользователя по карте Telegram ID -> строка — без чтения листа.
+
+    Карта пополняется при добавлении строк ботом и правится после его записей;
+    устаревший адрес обнаружит checked_row_update при записи. Если пользователя
+    нет (его добавили вручную или зарегистрировал другой процесс), лист
+    перечитывается — не чаще раза в USER_MISS_REREAD секунд.
+    """
+    user_index.loaded_rows()
+    entry = user_index.by_id.get(str(telegram_id))
+    if entry is None and user_index.reload_if_older(USER_MISS_REREAD):
+        entry = user_index.by_id.get(str(telegram_id))
+    return entry
+
+
+async def find_user_row(telegram_id):
+    """Как locate_user, но если пользователя нет — дожидается очереди записей
+    (заявка могла ещё не дойти до таблицы) и перечитывает лист."""
+    entry = locate_user(telegram_id)
+    if entry is None:
+        await sheets_outbox.drain()
+        user_index.invalidate()
+        entry = locate_user(telegram_id)
+    return entry
+
+
+def apply_sheet_op(sheet_name: str, op: str, payload: dict):
+    """Один вызов Google Sheets для операции очереди (выполняется в потоке)."""
+    worksheet = OUTBOX_SHEETS[sheet_name]
+    if op == "append":
+        return worksheet.append_row(payload["values"])
+    if op == "car_update":
+        cells = {int(column): value for column, value in payload["cells"].items()}
+        return checked_row_update(traced_spreadsheet, worksheet, car_index, locate_car, payload["car"], 0, cells, METRICS)
+    if op == "user_update":
+        # Ключ — Telegram ID в столбце E
+        cells = {int(column): value for column, value in payload["cells"].items()}
+        return checked_row_update(
+            traced_spreadsheet, worksheet, user_index, locate_user, payload["telegram_id"], 4, cells, METRICS
+        )
+    if op == "users_bulk_update":
+        # Строки ищутся по Telegram ID в момент записи; записи с изменившимся статусом пропускаются
+        updates = {
+            str(telegram_id): {int(column): value for column, value in cells.items()}
+            for telegram_id, cells in payload["users"].items()
+        }
+        expect = {int(column): value for column, value in payload.get("expect", {}).items()}
+        # Записанные строки не повторяем: их заявки уже не «Ожидает», и expect их пропустит.
+        # Сдвинутые — ищем заново по перечитанному листу
+        written = {}
+        for attempt in range(BULK_ROW_ATTEMPTS):
+            try:
+                written.update(checked_rows_update(
+                    traced_spreadsheet, worksheet, user_index, locate_user, 4, updates, expect, METRICS
+                ))
+                return written
+            except RowMoved as e:
+                written.update(e.written)
+                updates = {key: cells for key, cells in updates.items() if key not in e.written}
+                if attempt + 1 == BULK_ROW_ATTEMPTS:
+                    logging.error(f"Заявки не записаны, строки сдвигаются: {e}")
+        return written
+    # Операцию из журнала не применить и повтором — очередь отложит её как ошибочную
+    raise ValueError(f"неизвестная операция очереди: {sheet_name}/{op}")
+
+
+async def already_applied(sheet_name: str, op: str, payload: dict) -> bool:
+    """Дошла ли до таблицы операция, прерванная падением процесса.
+
+    Дописывать строку второй раз нельзя, поэтому append проверяется по листу;
+    записи по адресу повторяются — они идемпотентны.
+    """
+    if op != "append":
+        return False
+    expected = [str(value) for value in payload["values"]]
+    if sheet_name == "changes":
+        name, phone, car, _, ts = expected
+        if fuel_index.db.execute(
+            "SELECT 1 FROM entries WHERE phone = ? AND car = ? AND ts = ?", (phone, car, ts)
+        ).fetchone():
+            return True
+        rows = await asyncio.to_thread(changes_sheet.get, f"A{fuel_index.next_row()}:E")
+    else:
+        rows = await asyncio.to_thread(OUTBOX_SHEETS[sheet_name].get_all_values)
+    return any(row[:len(expected)] == expected for row in rows)
+
+
+def after_sheet_op(sheet_name: str, op: str, payload: dict, result):
+    """Обновляет локальные индексы после применения операции."""
+    if sheet_name == "changes" and op == "append":
+        fuel_index.add_appended(result, payload["values"])
+        return
+    cache = {"users": user_index, "cars": car_index}.get(sheet_name)
+    if cache is None:
+        return
+    if op == "append":
+        cache.add_appended(result, payload["values"])
+    elif op in ("car_update", "user_update"):
+        # result — проверенный номер строки
+        cache.patch_row(result, {int(column): value for column, value in payload["cells"].items()})
+    elif op == "users_bulk_update":
+        # result — {Telegram ID: проверенный номер строки} для записанных строк
+        for telegram_id, row in result.items():
+            cache.patch_row(row, {int(column): value for column, value in payload["users"][telegram_id].items()})
+        if "notify" in payload:
+            run_in_background(notify_bulk_pending(payload, list(result)))
+    else:
+        cache.invalidate()
+
+
+async def apply_outbox():
+    """Фоновая задача: при запуске довыполняет очередь, затем применяет новые операции."""
+    sheets_outbox.compact()
+    compacted_at = time.monotonic()
+    while True:
+        try:
+            if await sheets_outbox.apply_pending(apply_sheet_op, already_applied, after_sheet_op):
+                continue
+        except Exception as e:
+            logging.error(f"Ошибка очереди записей: {e}")
+        if time.monotonic() - compacted_at > 3600:
+            sheets_outbox.compact()
+            compacted_at = time.monotonic()
+        sheets_outbox.wakeup.clear()
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(sheets_outbox.wakeup.wait(), OUTBOX_POLL_INTERVAL)
+
+
+async def watch_stock_readings():
+    """Фоновая задача: проверяет показания остатка, как только они появились в очереди записей.
+
+    Проверка не ждёт записи в таблицу — показание, которое очередь не сможет
+    записать (ошибка API, операция отложена), всё равно проверяется.
+    """
+    while True:
+        try:
+            for _, sheet_name, op, payload in sheets_outbox.take_new("anomaly_detector"):
+                if sheet_name == "changes" and op == "append":
+                    check_stock_reading(payload["values"])
+        except Exception as e:
+            logging.error(f"Ошибка проверки новых показаний: {e}")
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+# ==================== МАССОВАЯ ОТПРАВКА ====================
+# Telegram допускает ~30 сообщений в секунду от одного бота — лимит общий для всех процессов
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "10"))
+# Сколько ждать ответа Telegram для одного получателя-админа (сек)
+ADMIN_NOTIFY_TIMEOUT = float(os.getenv("ADMIN_NOTIFY_TIMEOUT", "10"))
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+
+def run_in_background(coro):
+    """Запускает корутину фоновой задачей, не дожидаясь её завершения."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+class RateLimiter:
+    """Равномерно распределяет отправки: не чаще rate сообщений в секунду.
+
+    При BOT_WORKERS > 1 лимит общий на все процессы: share() подставляет
+    multiprocessing.Value со временем следующего слота (по time.monotonic,
+    она общая для процессов одной машины).
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+        self._shared_slot = None
+
+    def share(self, shared_slot):
+        self._shared_slot = shared_slot
+
+    async def wait(self):
+        if self._shared_slot is not None:
+            with self._shared_slot.get_lock():  # Короткая секция, цикл почти не ждёт
+                now = time.monotonic()
+                delay = self._shared_slot.value - now
+                self._shared_slot.value = max(now, self._shared_slot.value) + self.interval
+        else:
+            async with self._lock:
+                now = asyncio.get_running_loop().time()
+                delay = self._next_slot - now
+                self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+broadcast_limiter = RateLimiter(BROADCAST_RATE)
+
+
+async def send_bulk(messages, timeout=None, metric="broadcast"):
+    """Параллельно отправляет сообщения с ограничением скорости.
+
+    messages — список кортежей (chat_id, text, reply_markup).
+    Ошибка или таймаут одного получателя не влияют на остальных.
+    Возвращает (список доставленных chat_id, словарь {chat_id: ошибка}).
+    """
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    sent, failed = [], {}
+
+    async def deliver(chat_id, text, reply_markup):
+        async with semaphore:
+            for _ in range(3):
+                await broadcast_limiter.wait()
+                try:
+                    await asyncio.wait_for(bot.send_message(chat_id, text, reply_markup=reply_markup), timeout)
+                    sent.append(chat_id)
+                    METRICS[f"{metric}_sent"] += 1
+                    return
+                except TelegramRetryAfter as e:
+                    await asyncio.sleep(e.retry_after)  # Telegram просит подождать
+                except asyncio.TimeoutError:
+                    failed[chat_id] = "таймаут"  # Не повторяем: сообщение могло дойти
+                    METRICS[f"{metric}_timeout"] += 1
+                    return
+                except TelegramForbiddenError as e:
+                    failed[chat_id] = str(e)  # Пользователь заблокировал бота — не повторяем
+                    break
+                except Exception as e:
+                    failed[chat_id] = str(e)
+                    break
+            else:
+                failed[chat_id] = "превышено число повторов"
+            METRICS[f"{metric}_failed"] += 1
+
+    started = asyncio.get_running_loop().time()
+    await asyncio.gather(*(deliver(*m) for m in messages))
+    METRICS[f"{metric}_seconds"] += asyncio.get_running_loop().time() - started
+    return sent, failed
+
+
+async def notify_admins(text, reply_markup=None):
+    """Уведомляет всех админов параллельно, с таймаутом на каждого получателя."""
+    messages = [(admin_id, text, reply_markup) for admin_id in ADMIN_IDS]
+    sent, failed = await send_bulk(messages, timeout=ADMIN_NOTIFY_TIMEOUT, metric="admin_notify")
+    for admin_id, error in failed.items():
+        logging.warning(f"Не удалось уведомить админа {admin_id}: {error}")
+    logging.info(f"Уведомление админам: доставлено {len(sent)}, ошибок {len(failed)}")
+    return sent, failed
+
 # ==================== СОСТОЯНИЯ ====================
 class Form(StatesGroup):
     phone_number = State()
@@ -68,6 +924,40 @@ class PhysicalStockState(StatesGroup):
     selecting_car = State()
     entering_stock = State()   
 
+class AdminState(StatesGroup):
+    selecting_user = State()
+    sending_message = State()
+    waiting_for_message = State()
+    selecting_car = State()
+    entering_stock = State()
+    waiting_for_broadcast = State()
+    searching_user = State()
+
+# ==================== CALLBACK DATA ====================
+class CarCallback(CallbackData, prefix="car"):
+    """Выбор машины: action — info (карточка), stock (физ. остаток), admin (остаток админом)."""
+    action: str
+    car_id: int
+
+
+class CarsPageCallback(CallbackData, prefix="cars"):
+    """Страница списка машин: action — info или stock."""
+    action: str
+    page: int
+
+
+class PagesCallback(CallbackData, prefix="pages"):
+    """Перелистывание длинного текста: key — ключ страниц в кэше text_pages."""
+    key: str
+    page: int
+
+
+class ReportCallback(CallbackData, prefix="report"):
+    """Выгрузка отчёта: period — day, week, month; fmt — csv или xlsx."""
+    period: str
+    fmt: str
+
+
 # ==================== КЛАВИАТУРЫ ====================
 main_menu = InlineKeyboardMarkup(
     inline_keyboard=[
@@ -75,8 +965,120 @@ main_menu = InlineKeyboardMarkup(
         [InlineKeyboardButton(text="⛽️Внести физ. остаток", callback_data="enter_physical_stock")]
     ]
 )
+# ==================== РЕДАКТИРОВАНИЕ СООБЩЕНИЙ ====================
+# (chat_id, message_id) -> (хэш последнего текста с клавиатурой, edit_date после нашей правки)
+rendered_messages = LRUCache(maxsize=10000)
+
+
+def render_digest(text, reply_markup=None) -> int:
+    return hash((text, reply_markup.model_dump_json(exclude_none=True) if reply_markup else None))
+
+
+async def safe_edit(message: Message, text: str, reply_markup=None) -> bool:
+    """Редактирует сообщение бота, только если текст или клавиатура меняются.
+
+    Хэш последней правки берётся из rendered_messages, если с тех пор сообщение
+    никто не менял (совпадает edit_date); иначе — из самого сообщения в callback.
+    Повторное нажатие той же кнопки не тратит запрос к Telegram.
+    Возвращает True, если сообщение было изменено.
+    """
+    key = (message.chat.id, message.message_id)
+    digest = render_digest(text, reply_markup)
+    cached = rendered_messages.get(key)
+    if cached is not None and cached[1] == message.edit_date:
+        current = cached[0]
+    else:
+        current = render_digest(message.text, message.reply_markup)
+    if current == digest:
+        METRICS["edit_skipped"] += 1
+        return False
+
+    try:
+        edited = await message.edit_text(text, reply_markup=reply_markup)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+        METRICS["edit_skipped"] += 1
+        return False
+    rendered_messages[key] = (digest, getattr(edited, "edit_date", None))
+    return True
+
+
+# ==================== ПОСТРАНИЧНЫЙ ВЫВОД ====================
+# Лимит длины сообщения Telegram (в UTF-16 символах)
+MESSAGE_LIMIT = 4096
+# Разбитые на страницы тексты: ключ -> (chat_id, страницы, нижние строки клавиатуры)
+text_pages = LRUCache(maxsize=500)
+
+
+def tg_len(text: str) -> int:
+    """Длина текста так, как её считает Telegram: эмодзи занимают две позиции."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def split_pages(header: str, lines, limit: int = MESSAGE_LIMIT):
+    """Жадно раскладывает строки по страницам не длиннее limit.
+
+    Каждая страница начинается с header; страниц получается минимум,
+    строка длиннее страницы режется на части.
+    """
+    budget = limit - tg_len(header) - 1
+    pages, current, size = [], [], 0
+    for line in lines:
+        while tg_len(line) > budget:  # Слишком длинная строка — отдельными кусками
+            cut = budget
+            while tg_len(line[:cut]) > budget:
+                cut -= 1
+            chunk, line = line[:cut], line[cut:]
+            if current:
+                pages.append(current)
+            pages.append([chunk])
+            current, size = [], 0
+        line_size = tg_len(line) + 1
+        if current and size + line_size > budget:
+            pages.append(current)
+            current, size = [], 0
+        current.append(line)
+        size += line_size
+    if current or not pages:
+        pages.append(current)
+    return ["\n".join([header, *page] if header else page) for page in pages]
+
+
+def pages_keyboard(key: str, page: int, total: int, tail_rows):
+    """Кнопки перелистывания страниц и нижние строки исходной клавиатуры."""
+    navigation_buttons = []
+    if page > 0:
+        navigation_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=PagesCallback(key=key, page=page - 1).pack()))
+    navigation_buttons.append(InlineKeyboardButton(text=f"{page + 1}/{total}", callback_data=PagesCallback(key=key, page=page).pack()))
+    if page < total - 1:
+        navigation_buttons.append(InlineKeyboardButton(text="➡️", callback_data=PagesCallback(key=key, page=page + 1).pack()))
+    return InlineKeyboardMarkup(inline_keyboard=[navigation_buttons, *tail_rows])
+
+
+async def render_pages(message: Message, header: str, lines, reply_markup=None, edit=False):
+    """Выводит длинный текст: одним сообщением, если помещается, иначе — страницами.
+
+    Страницы собираются один раз и хранятся в text_pages, поэтому
+    перелистывание — одно редактирование без пересборки данных.
+    edit=True — заменить текст message (сообщение бота), иначе ответить новым.
+    """
+    pages = split_pages(header, lines)
+    if len(pages) == 1:
+        keyboard = reply_markup
+    else:
+        key = uuid.uuid4().hex[:12]
+        tail_rows = reply_markup.inline_keyboard if reply_markup else []
+        text_pages[key] = (message.chat.id, pages, tail_rows)
+        keyboard = pages_keyboard(key, 0, len(pages), tail_rows)
+    if edit:
+        await safe_edit(message, pages[0], reply_markup=keyboard)
+    else:
+        await message.answer(pages[0], reply_markup=keyboard)
+
+
 # ==================== ОБРАБОТЧИКИ ====================
-@dp.message(Command("start"))
+@registration_router.message(Command("start"))
 async def start(message: Message, state: FSMContext):
     """Проверяет, есть ли пользователь в таблице, и либо запрашивает данные, либо приветствует."""
     telegram_id = message.from_user.id  # ID текущего пользователя
@@ -104,7 +1106,7 @@ async def start(message: Message, state: FSMContext):
         await state.set_state(Form.phone_number)
         await message.answer("Добро пожаловать! Введите ваш 📞номер телефона в формате +7XXXXXXXXXX:")
 
-@dp.message(Form.phone_number)
+@registration_router.message(Form.phone_number)
 async def get_phone(message: Message, state: FSMContext):
     """Обрабатывает ввод номера телефона."""
     phone = message.text.strip()
@@ -117,12 +1119,20 @@ async def get_phone(message: Message, state: FSMContext):
     await state.set_state(Form.full_name)
     await message.answer("Теперь введите ваше 👤ФИО:")
 
-@dp.message(Form.full_name)
+@registration_router.message(Form.full_name)
 async def save_full_name(message: Message, state: FSMContext):
     """Обрабатывает ввод ФИО и отправляет заявку админу."""
     full_name = message.text.strip()
     user_data = await state.get_data()
 
+    # Повторная отправка ФИО не должна создавать вторую строку заявки
+    if message.from_user.id in recent_registrations or user_index.get(message.from_user.id):
+        METRICS["duplicate_registrations"] += 1
+        await state.set_state(Form.waiting_admin_confirmation)
+        await message.answer("⏳ Ваша заявка на подтверждение уже отправлена. Ожидайте ответа администратора.")
+        return
+    recent_registrations[message.from_user.id] = True
+
     user_data.update({
         "full_name": full_name,
         "telegram_id": message.from_user.id,  # ID клиента
@@ -133,14 +1143,14 @@ async def save_full_name(message: Message, state: FSMContext):
     await state.set_state(Form.waiting_admin_confirmation)  
     await message.answer("Ожидайте подтверждения от администратора.")
 
-    # Сохраняем данные клиента в Google Sheets
-    sheet.append_row([
+    # Сохраняем данные клиента в Google Sheets (через очередь записей)
+    sheets_outbox.enqueue(f"register:{user_data['telegram_id']}:{message.message_id}", [("users", "append", {"values": [
         user_data['phone_number'],
         user_data['full_name'],
         user_data['registration_date'],
         "Ожидает",  # Статус "Ожидает"
         user_data['telegram_id']
-    ])
+    ]})])
 
     # Клавиатура с персональными данными клиента
     confirmation_keyboard = InlineKeyboardMarkup(
@@ -150,21 +1160,19 @@ async def save_full_name(message: Message, state: FSMContext):
         ]
     )
 
-    # Уведомление администраторам
-    for admin_id in ADMIN_IDS:
-        await bot.send_message(
-            admin_id,
-            f"🚗 Новый запрос на авторизацию 🚗\n\n"
-            f"📞 Телефон: {user_data['phone_number']}\n"
-            f"👤 ФИО: {user_data['full_name']}\n"
-            f"🆔 Telegram ID: {user_data['telegram_id']}\n"
-            f"⏳ Дата регистрации: {user_data['registration_date']}\n\n"
-            f"Подтвердить?",
-            reply_markup=confirmation_keyboard
-        )
+    # Уведомление администраторам — в фоне, водитель уже получил ответ
+    run_in_background(notify_admins(
+        f"🚗 Новый запрос на авторизацию 🚗\n\n"
+        f"📞 Телефон: {user_data['phone_number']}\n"
+        f"👤 ФИО: {user_data['full_name']}\n"
+        f"🆔 Telegram ID: {user_data['telegram_id']}\n"
+        f"⏳ Дата регистрации: {user_data['registration_date']}\n\n"
+        f"Подтвердить?",
+        reply_markup=confirmation_keyboard
+    ))
 
 
-@dp.callback_query(F.data.startswith("confirm_user:"))
+@registration_router.callback_query(F.data.startswith("confirm_user:"))
 async def confirm_user_handler(callback_query: CallbackQuery):
     """Подтверждение пользователя и изменение статуса в Google Sheets"""
     # Получаем Telegram ID клиента из callback_data
@@ -177,29 +1185,17 @@ async def confirm_user_handler(callback_query: CallbackQuery):
 
     telegram_id = int(telegram_id)  # Преобразуем в int
 
-    # Получаем все записи из Google Sheets
-    existing_records = sheet.get_all_records()
-
-    # Ищем пользователя в таблице по Telegram ID
-    user_exists = False
-    row = None
-
-    for index, record in enumerate(existing_records, start=2):  # Начинаем со 2-й строки
-        record_telegram_id = str(record.get("Telegram ID", "")).strip()
-
-        if record_telegram_id.isdigit() and int(record_telegram_id) == telegram_id:
-            user_exists = True
-            row = index  # Запоминаем строку пользователя
-            break
-
-    if not user_exists:
+    # Ищем пользователя по карте строк (заявка могла ещё не дойти до таблицы из очереди записей)
+    if not await find_user_row(telegram_id):
         await callback_query.answer("❌ Пользователь не найден в базе.")
         await callback_query.message.edit_text(f"❌ Пользователь с Telegram ID {telegram_id} не найден.")
         return
 
-    # Изменяем статус на "Подтвержден" в таблице
-    sheet.update_cell(row, 4, "Подтвержден")  # Столбец 4 — это "Статус"
-    sheet.update_cell(row, 6, "Свободен")
+    # Изменяем статус на "Подтвержден" в таблице: оба столбца — одной операцией
+    sheets_outbox.enqueue(f"confirm:{telegram_id}:{callback_query.id}", [("users", "user_update", {
+        "telegram_id": telegram_id,
+        "cells": {3: "Подтвержден", 5: "Свободен"},  # Столбец D — это "Статус", F — статус рейса
+    })])
 
     # Отправляем клиенту уведомление
     await bot.send_message(telegram_id, "✅ Ваш вход подтвержден! Добро пожаловать!", reply_markup=main_menu)
@@ -208,7 +1204,7 @@ async def confirm_user_handler(callback_query: CallbackQuery):
     await callback_query.answer("✅ Пользователь подтвержден.")
     await callback_query.message.edit_text(f"✅ Пользователь {telegram_id} подтвержден.", reply_markup=main_menu)
 
-@dp.callback_query(F.data.startswith("block_user:"))
+@registration_router.callback_query(F.data.startswith("block_user:"))
 async def block_user_handler(callback_query: CallbackQuery):
     """Отклоняет пользователя и меняет статус на 'Отклонено'."""
     telegram_id = callback_query.data.split(":")[1]  # Получаем ID клиента из callback_data
@@ -219,25 +1215,17 @@ async def block_user_handler(callback_query: CallbackQuery):
 
     telegram_id = int(telegram_id)  # Преобразуем в int
 
-    # Получаем все записи из Google Sheets
-    existing_records = sheet.get_all_records()
-    user_found = False
-    row = None
-
-    for index, record in enumerate(existing_records, start=2):
-        record_telegram_id = str(record.get("Telegram ID", "")).strip()
-        if record_telegram_id.isdigit() and int(record_telegram_id) == telegram_id:
-            user_found = True
-            row = index  # Номер строки в таблице
-            break
-
-    if not user_found:
+    # Ищем пользователя по карте строк (заявка могла ещё не дойти до таблицы из очереди записей)
+    if not await find_user_row(telegram_id):
         await callback_query.answer("❌ Пользователь не найден в базе.")
         await callback_query.message.edit_text(f"❌ Пользователь с Telegram ID {telegram_id} не найден.")
         return
 
     # Обновляем статус в таблице на "Отклонено"
-    sheet.update_cell(row, 4, "Отклонено")
+    sheets_outbox.enqueue(f"block:{telegram_id}:{callback_query.id}", [("users", "user_update", {
+        "telegram_id": telegram_id,
+        "cells": {3: "Отклонено"},
+    })])
 
     # Уведомляем пользователя
     await bot.send_message(telegram_id, "🚫 Ваш доступ был отклонен администратором.")
@@ -246,74 +1234,112 @@ async def block_user_handler(callback_query: CallbackQuery):
     await callback_query.answer("Пользователь отклонен.")
     await callback_query.message.edit_text(f"🚫 Пользователь {telegram_id} отклонен и заблокирован.", reply_markup=main_menu)
 
-# ================== Главное меню =============
-def get_cars_keyboard(page: int):
-    """Создаёт клавиатуру с машинами и кнопками листания"""
-    cars = cars_sheet.get_all_values()[1:]  # Получаем все строки (кроме заголовков)
-    total_pages = (len(cars) + CARS_PER_PAGE - 1) // CARS_PER_PAGE  # Кол-во страниц
+# ================== Недавние машины =============
+# Сколько последних машин водителя показывать первой строкой
+RECENT_CARS_LIMIT = 3
+# Telegram ID -> номера последних выбранных машин (новые первыми); число водителей ограничено
+recent_cars = LRUCache(maxsize=10000)
 
-    start = (page - 1) * CARS_PER_PAGE
-    end = start + CARS_PER_PAGE
-    cars_on_page = cars[start:end]
 
-    buttons = [
-        [InlineKeyboardButton(text=f"🚙 {car[0]}", callback_data=f"car_info:{car[0]}")]
-        for car in cars_on_page
+def remember_car(user_id: int, car_number: str):
+    """Запоминает машину в истории водителя."""
+    cars = [car_number] + [car for car in recent_cars.get(user_id, []) if car != car_number]
+    recent_cars[user_id] = cars[:RECENT_CARS_LIMIT]
+
+
+def get_recent_cars_row(user_id, action: str):
+    """Строка клавиатуры с недавними машинами водителя (или пустой список)."""
+    return [
+        InlineKeyboardButton(text=f"⭐️ {car}", callback_data=CarCallback(action=action, car_id=car_index.car_ids[car]).pack())
+        for car in recent_cars.get(user_id, [])
+        if car_index.get(car)  # Машину могли удалить из таблицы
     ]
 
+
+# ================== Главное меню =============
+def get_cars_page(action: str, page: int):
+    """Кнопки машин одной страницы из кэша текущей версии каталога.
+
+    Возвращает (страница, всего страниц, кнопки); номер страницы приводится
+    к допустимому, чтобы кнопки из старых сообщений не приводили к ошибке.
+    """
+    cars = [car for car in car_index.get_rows() if car and car[0].strip()]
+    total_pages = max(1, (len(cars) + CARS_PER_PAGE - 1) // CARS_PER_PAGE)  # Кол-во страниц
+    page = min(max(page, 1), total_pages)
+
+    if (action, page) not in car_index.pages:
+        start = (page - 1) * CARS_PER_PAGE
+        car_index.pages[(action, page)] = [
+            [InlineKeyboardButton(text=f"🚙 {car[0]}", callback_data=CarCallback(action=action, car_id=car_index.car_ids[car[0]]).pack())]
+            for car in cars[start:start + CARS_PER_PAGE]
+        ]
+    return page, total_pages, car_index.pages[(action, page)]
+
+
+def get_cars_keyboard(page: int, user_id: int = None, action: str = "info"):
+    """Создаёт клавиатуру с машинами и кнопками листания
+    (action=stock — для внесения физ. остатка, admin — для остатка админом)"""
+    page, total_pages, car_buttons = get_cars_page(action, page)
+    buttons = list(car_buttons)
+
+    # Недавние машины водителя — первой строкой на первой странице
+    recent_row = get_recent_cars_row(user_id, action) if page == 1 else []
+    if recent_row:
+        buttons.insert(0, recent_row)
+
     # Кнопки перелистывания
     navigation_buttons = []
     if page > 1:
-        navigation_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"view_cars_page:{page - 1}"))
+        navigation_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=CarsPageCallback(action=action, page=page - 1).pack()))
     if page < total_pages:
-        navigation_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"view_cars_page:{page + 1}"))
+        navigation_buttons.append(InlineKeyboardButton(text="➡️", callback_data=CarsPageCallback(action=action, page=page + 1).pack()))
 
     if navigation_buttons:
         buttons.append(navigation_buttons)
 
     # Добавляем кнопку "Вернуться в главное меню"
-    buttons.append([InlineKeyboardButton(text="🏠 Вернуться в главное меню", callback_data="back_to_main_menu")])
+    if action == "admin":
+        buttons.append([InlineKeyboardButton(text="Вернуться в админ-меню", callback_data="admin_inline_menu")])
+    else:
+        buttons.append([InlineKeyboardButton(text="🏠 Вернуться в главное меню", callback_data="back_to_main_menu")])
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
 
-@dp.callback_query(F.data == "view_cars")
+@driver_router.callback_query(F.data == "view_cars")
 async def view_cars(callback_query: CallbackQuery):
     """Вывод первой страницы машин"""
-    await callback_query.message.edit_text("📋 Список машин:", reply_markup=get_cars_keyboard(1))
+    await safe_edit(callback_query.message, "📋 Список машин:", reply_markup=get_cars_keyboard(1, callback_query.from_user.id))
 
-@dp.callback_query(F.data.startswith("view_cars_page:"))
-async def change_page(callback_query: CallbackQuery):
+@driver_router.callback_query(CarsPageCallback.filter(F.action == "info"))
+async def change_page(callback_query: CallbackQuery, callback_data: CarsPageCallback):
     """Переключение страниц списка машин"""
-    page = int(callback_query.data.split(":")[1])
-    await callback_query.message.edit_text("📋 Список машин:", reply_markup=get_cars_keyboard(page))
+    await safe_edit(callback_query.message, "📋 Список машин:", reply_markup=get_cars_keyboard(callback_data.page, callback_query.from_user.id))
 
-@dp.callback_query(F.data == "back_to_main_menu")
+@driver_router.callback_query(F.data.in_({"back_to_main_menu", "main_menu"}))
 async def back_to_main_menu(callback_query: CallbackQuery):
     """Возвращает пользователя в главное меню"""
-    await callback_query.message.edit_text("🏠 Главное меню", reply_markup=main_menu)
+    await safe_edit(callback_query.message, "🏠 Главное меню", reply_markup=main_menu)
 
 # ===========# ==================== Вывод информации о машине ====================
-@dp.callback_query(F.data.startswith("car_info:"))
-async def car_info(callback_query: CallbackQuery):
+@driver_router.callback_query(CarCallback.filter(F.action == "info"))
+async def car_info(callback_query: CallbackQuery, callback_data: CarCallback):
     """Вывод информации о машине (номер, остаток, дата изменения)"""
-    car_number = callback_query.data.split(":")[1]
-    cars = cars_sheet.get_all_values()[1:]  # Получаем все строки, пропуская заголовок
-    users = sheet.get_all_values()[1:]
-    user_id = str(callback_query.from_user.id)
-
-    car_row = None
-    for index, car in enumerate(cars, start=2):
-        if car[0] == car_number:
-            car_row = index
-            break
-    for index, user in enumerate(users,start=2):
-        if len(user) > 4 and user[4] == user_id:
-            sheet.update_cell(index, 6, "В рейсе")
-            break
+    car_number = car_index.car_number(callback_data.car_id)
+    if not car_number:
+        await callback_query.answer("❌ Информация не найдена")
+        return
+    cars = car_index.get_rows()  # Все строки машин из кэша
+    user_id = callback_query.from_user.id
+    # Одна адресная запись статуса по карте строк, без чтения листа пользователей
+    if locate_user(user_id):
+        sheets_outbox.enqueue(f"status:{user_id}:{callback_query.id}", [("users", "user_update", {
+            "telegram_id": user_id, "cells": {5: "В рейсе"},
+        })])
 
     for car in cars:
         if car[0] == car_number:  # Номер машины найден
+            remember_car(callback_query.from_user.id, car_number)
             stock = car[1] if len(car) > 1 else "Нет данных"
             last_update = car[2] if len(car) > 2 else "Неизвестно"
 
@@ -324,7 +1350,8 @@ async def car_info(callback_query: CallbackQuery):
                 ]
             )
             
-            await callback_query.message.edit_text(
+            await safe_edit(
+                callback_query.message,
                 f"🚙 Машина: {car_number}\n⛽️ Остаток: {stock} л\n📅 Последнее изменение: {last_update}",
                 reply_markup=keyboard
             )
@@ -332,91 +1359,102 @@ async def car_info(callback_query: CallbackQuery):
 
     await callback_query.answer("❌ Информация не найдена")
 
-# ==================== Главное меню ====================
-@dp.callback_query(F.data == "main_menu")
-async def back_to_main_menu(callback_query: CallbackQuery):
-    """Возвращает главное меню"""
-    await callback_query.message.edit_text("🏠 Главное меню:", reply_markup=main_menu)
+# ==================== Поиск машины (inline-режим) ====================
+@driver_router.inline_query()
+async def search_cars_inline(inline_query: InlineQuery):
+    """Ищет машину по номеру прямо из строки ввода: @бот A123."""
+    user = user_index.get(inline_query.from_user.id)
+    if not user or user[1][3] != "Подтвержден":
+        await inline_query.answer([], cache_time=60, is_personal=True)
+        return
 
-# ==================== Выбор машин ====================
-@dp.callback_query(F.data == "view_cars")
-async def view_cars(callback_query: CallbackQuery):
-    """Вывод первой страницы машин"""
-    await callback_query.message.edit_text("📋 Список машин:", reply_markup=get_cars_keyboard(1))
+    results = []
+    for car in car_index.search(inline_query.query, limit=20):
+        _, row = car_index.get(car)
+        stock = row[1] if len(row) > 1 and row[1] else "Нет данных"
+        results.append(InlineQueryResultArticle(
+            id=str(car_index.car_ids[car]),  # Номера, разные в листе, могут совпасть после normalize_plate
+            title=f"🚙 {car}",
+            description=f"⛽️ Остаток: {stock} л",
+            input_message_content=InputTextMessageContent(message_text=f"/car {car}")
+        ))
+    await inline_query.answer(results, cache_time=30, is_personal=True)
+
+
+@driver_router.message(Command("car"))
+async def car_command(message: Message, command: CommandObject):
+    """Открывает карточку машины, выбранной через inline-поиск."""
+    user = user_index.get(message.from_user.id)
+    if not user or user[1][3] != "Подтвержден":
+        return
+
+    found = car_index.search(command.args or "", limit=1)
+    if not found:
+        await message.answer("❌ Машина не найдена.", reply_markup=main_menu)
+        return
+
+    car_number = found[0]
+    _, car = car_index.get(car_number)
+    remember_car(message.from_user.id, car_number)
+    stock = car[1] if len(car) > 1 else "Нет данных"
+    last_update = car[2] if len(car) > 2 else "Неизвестно"
+
+    # Как и при выборе из списка, водитель отмечается «В рейсе»
+    sheets_outbox.enqueue(f"status:{message.from_user.id}:{message.message_id}", [("users", "user_update", {
+        "telegram_id": message.from_user.id, "cells": {5: "В рейсе"},
+    })])
+
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="⛽️ Внести физ. остаток", callback_data=CarCallback(action="stock", car_id=car_index.car_ids[car_number]).pack())],
+            [InlineKeyboardButton(text="🏠 Главное меню", callback_data="main_menu")]
+        ]
+    )
+    await message.answer(
+        f"🚙 Машина: {car_number}\n⛽️ Остаток: {stock} л\n📅 Последнее изменение: {last_update}",
+        reply_markup=keyboard
+    )
 
 # ==================== Изменение физ. остатка ====================
-@dp.callback_query(F.data == "enter_physical_stock")
+@driver_router.callback_query(F.data == "enter_physical_stock")
 async def select_car_for_physical_stock(callback_query: CallbackQuery, state: FSMContext):
     """Отображает список машин перед внесением физ. остатка."""
-    cars = cars_sheet.col_values(1)[1:]  # Получаем список машин (пропускаем заголовок)
+    cars = car_index.get_rows()  # Список машин из кэша
 
     if not cars:
         await callback_query.message.answer("🚗 Список машин пуст.")
         return
 
     page = 1  # Начинаем с первой страницы
-    await callback_query.message.answer("📋 Выберите машину для внесения физ. остатка:", reply_markup=get_cars_keyboard_for_stock(page))
-
-# ==================== Функция создания клавиатуры для физ. остатка ====================
-def get_cars_keyboard_for_stock(page: int):
-    """Создаёт клавиатуру с машинами и кнопками листания для внесения физ. остатка"""
-    cars = cars_sheet.get_all_values()[1:]  # Получаем все строки (кроме заголовков)
-    total_pages = (len(cars) + CARS_PER_PAGE - 1) // CARS_PER_PAGE  # Кол-во страниц
-
-    start = (page - 1) * CARS_PER_PAGE
-    end = start + CARS_PER_PAGE
-    cars_on_page = cars[start:end]
-
-    buttons = [
-        [InlineKeyboardButton(text=f"🚙 {car[0]}", callback_data=f"select_physical_car:{car[0]}")]
-        for car in cars_on_page
-    ]
-
-    # Кнопки перелистывания
-    navigation_buttons = []
-    if page > 1:
-        navigation_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"enter_physical_stock_page:{page - 1}"))
-    if page < total_pages:
-        navigation_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"enter_physical_stock_page:{page + 1}"))
+    # Меню заменяется на месте, как при просмотре машин, а не дублируется новым сообщением
+    await safe_edit(callback_query.message, "📋 Выберите машину для внесения физ. остатка:", reply_markup=get_cars_keyboard(page, callback_query.from_user.id, action="stock"))
 
-    if navigation_buttons:
-        buttons.append(navigation_buttons)
-
-    # Добавляем кнопку "Вернуться в главное меню"
-    buttons.append([InlineKeyboardButton(text="🏠 Вернуться в главное меню", callback_data="back_to_main_menu")])
-
-    return InlineKeyboardMarkup(inline_keyboard=buttons)
-
-
-@dp.callback_query(F.data.startswith("enter_physical_stock_page:"))
-async def change_page_for_physical_stock(callback_query: CallbackQuery):
+@driver_router.callback_query(CarsPageCallback.filter(F.action == "stock"))
+async def change_page_for_physical_stock(callback_query: CallbackQuery, callback_data: CarsPageCallback):
     """Переключение страниц списка машин для физ. остатка"""
-    page = int(callback_query.data.split(":")[1])
-    await callback_query.message.edit_text(
+    await safe_edit(
+        callback_query.message,
         "📋 Выберите машину для внесения физ. остатка:",
-        reply_markup=get_cars_keyboard_for_stock(page)
+        reply_markup=get_cars_keyboard(callback_data.page, callback_query.from_user.id, action="stock")
     )
 
 
-@dp.callback_query(F.data == "back_to_main_menu")
-async def back_to_main_menu(callback_query: CallbackQuery):
-    """Возвращает пользователя в главное меню"""
-    await callback_query.message.edit_text("🏠 Главное меню", reply_markup=main_menu)
-
 # ==================== Выбор машины для физ. остатка ====================
-@dp.callback_query(F.data.startswith("select_physical_car:"))
-async def select_physical_car(callback_query: CallbackQuery, state: FSMContext):
+@driver_router.callback_query(CarCallback.filter(F.action == "stock"))
+async def select_physical_car(callback_query: CallbackQuery, state: FSMContext, callback_data: CarCallback):
     """Запрашивает ввод физ. остатка для выбранной машины"""
-    car_number = callback_query.data.split(":")[1]
+    car_number = car_index.car_number(callback_data.car_id)
+    if not car_number:
+        await callback_query.answer("❌ Машина не найдена")
+        return
     await state.update_data(selected_car=car_number)
+    remember_car(callback_query.from_user.id, car_number)
 
     await callback_query.message.answer(f"🚙 Вы выбрали машину {car_number}.\nВведите физ. остаток топлива в баке (л):")
     await state.set_state(PhysicalStockState.entering_stock)
 
 # ==================== Ввод физ. остатка ====================
-from datetime import datetime
-print(datetime.now())
-@dp.message(PhysicalStockState.entering_stock)
+@driver_router.message(PhysicalStockState.entering_stock)
 async def save_physical_stock(message: Message, state: FSMContext):
     """Сохраняет физический остаток в Google Sheets."""
     physical_stock = message.text.strip()
@@ -429,20 +1467,21 @@ async def save_physical_stock(message: Message, state: FSMContext):
     selected_car = user_data["selected_car"]
     telegram_id = message.from_user.id
 
-    # Получаем данные клиента из первого листа
-    clients_sheet = client.open_by_key(SPREADSHEET_ID).sheet1
-    records = clients_sheet.get_all_records()
-
-    client_info = None
-    row_number = None
+    # Двойная отправка того же показания: проверка и отметка без await между ними
+    fingerprint = (telegram_id, selected_car, physical_stock)
+    if fingerprint in recent_stock_submissions:
+        METRICS["duplicate_stock_submissions"] += 1
+        await message.answer(f"✅ Остаток {physical_stock} л по машине {selected_car} уже записан.", reply_markup=main_menu)
+        await state.clear()
+        return
+    recent_stock_submissions[fingerprint] = True
 
-    for i, record in enumerate(records, start=2):
-        if str(record.get("Telegram ID", "")).strip() == str(telegram_id):
-            client_info = record
-            row_number = i
-            break
+    # ФИО и телефон копируются в «Изменения» — берём их из кэша с обновлением по TTL,
+    # а если водителя там нет — из перечитанного листа
+    client_info = user_index.get(telegram_id) or locate_user(telegram_id)
 
     if not client_info:
+        recent_stock_submissions.pop(fingerprint, None)  # Показание не записано
         await message.answer("❌ Ваши данные не найдены в системе.")
         await state.clear()
         return
@@ -452,17 +1491,17 @@ async def save_physical_stock(message: Message, state: FSMContext):
                 ]
             )
 
-    full_name = client_info.get("ФИО", "Неизвестно")
-    phone_number = client_info.get("Телефон", "Неизвестно")
-    from datetime import datetime
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    # Записываем данные в лист «Изменения»
-    changes_sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Изменения")
-    changes_sheet.append_row([
-        full_name, phone_number, selected_car, physical_stock, current_time
+    _, client_row = client_info
+    phone_number = client_row[0] or "Неизвестно"  # Столбец A — телефон
+    full_name = client_row[1] if len(client_row) > 1 and client_row[1] else "Неизвестно"  # Столбец B — ФИО
+    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    # Записываем данные в лист «Изменения» и статус водителя — одной транзакцией очереди
+    entry = [full_name, phone_number, selected_car, physical_stock, current_time]
+    sheets_outbox.enqueue(f"stock:{telegram_id}:{message.message_id}", [
+        ("changes", "append", {"values": entry}),
+        ("users", "user_update", {"telegram_id": telegram_id, "cells": {5: "Свободен"}}),
     ])
-
-    clients_sheet.update_cell(row_number,6 , "Свободен")
+    # Показание проверит детектор аномалий основного процесса, увидев его в очереди (watch_stock_readings)
 
     await message.answer(f"✅ Данные записаны:\n👤 ФИО: {full_name}\n📞 Телефон: {phone_number}\n🚙 Машина: {selected_car}\n⛽️ Остаток: {physical_stock} л", reply_markup=keyboard)
 
@@ -471,20 +1510,14 @@ async def save_physical_stock(message: Message, state: FSMContext):
 
 
 # ============= АДМИН =================
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.fsm.state import State, StatesGroup
-
-# ==================== СОСТОЯНИЯ ====================
-class AdminState(StatesGroup):
-    selecting_car = State()
-    entering_stock = State()
-
 # ==================== ИНЛАЙН-КЛАВИАТУРА ДЛЯ АДМИНА ====================
 admin_inline_menu = InlineKeyboardMarkup(
     inline_keyboard=[
         [InlineKeyboardButton(text="📋 Получить информацию", callback_data="get_info")],
         [InlineKeyboardButton(text="✏️ Внести остаток", callback_data="admin_update_stock")],
-        [InlineKeyboardButton(text="📢 Уведомление", callback_data="admin_notify")]
+        [InlineKeyboardButton(text="📢 Уведомление", callback_data="admin_notify")],
+        [InlineKeyboardButton(text="👥 Заявки на подтверждение", callback_data="admin_pending")],
+        [InlineKeyboardButton(text="📑 Отчёты", callback_data="admin_reports")]
     ]
 )
 # Кнопка для возврата в админ-меню
@@ -494,7 +1527,7 @@ admin_inline_go_menu = InlineKeyboardMarkup(
     ]
 )
 # ==================== ПАНЕЛЬ АДМИНА ====================
-@dp.message(Command("admin"))
+@admin_router.message(Command("admin"))
 async def show_admin_panel(message: Message):
     """Показывает инлайн-меню администратора."""
     if message.from_user.id not in ADMIN_IDS:
@@ -504,47 +1537,44 @@ async def show_admin_panel(message: Message):
     await message.answer("🔧 Панель администратора:", reply_markup=admin_inline_menu)
 
 # ==================== ВНЕСЕНИЕ ОСТАТКА ====================
-@dp.callback_query(F.data == "admin_update_stock")
+@admin_router.callback_query(F.data == "admin_update_stock")
 async def select_car_for_stock_update(callback: CallbackQuery, state: FSMContext):
     """Отображает список машин перед обновлением остатка."""
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("⛔️ У вас нет доступа к этой функции.")
         return
    
-    sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Состояние машины")
-    cars = sheet.col_values(1)[1:]  # Получаем список машин (пропускаем заголовок)
-
-    if not cars:
+    car_index.get_rows()
+    if not car_index.by_number:  # Список машин из кэша
         await callback.message.answer("🚗 Список машин пуст.")
         return
 
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=car, callback_data=f"select_car:{car}")] for car in cars
-        ]
-    )
+    # Постранично: в клавиатуре Telegram не больше 100 кнопок
+    keyboard = get_cars_keyboard(1, action="admin")
 
-    # Добавляем кнопку для возврата в админ-меню
-    return_button = InlineKeyboardButton(text="Вернуться в админ-меню", callback_data="admin_inline_menu")
-    keyboard.inline_keyboard.append([return_button])
-    
     await state.set_state(AdminState.selecting_car)
     
     # Сохраняем ID сообщения для дальнейшего редактирования
     await state.update_data(message_id=callback.message.message_id)
     
     # Редактируем предыдущее сообщение с предложением выбора машины
-    await callback.message.bot.edit_message_text(
-        text="Выберите машину для изменения остатка:",
-        chat_id=callback.message.chat.id,
-        message_id=callback.message.message_id,
-        reply_markup=keyboard
-    )
+    await safe_edit(callback.message, "Выберите машину для изменения остатка:", reply_markup=keyboard)
 
-@dp.callback_query(F.data.startswith("select_car:"))
-async def enter_stock_value(callback: CallbackQuery, state: FSMContext):
+@admin_router.callback_query(CarsPageCallback.filter(F.action == "admin"))
+async def change_page_for_stock_update(callback: CallbackQuery, callback_data: CarsPageCallback):
+    """Перелистывание списка машин для внесения остатка."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+    await safe_edit(callback.message, "Выберите машину для изменения остатка:", reply_markup=get_cars_keyboard(callback_data.page, action="admin"))
+
+@admin_router.callback_query(CarCallback.filter(F.action == "admin"))
+async def enter_stock_value(callback: CallbackQuery, state: FSMContext, callback_data: CarCallback):
     """Запрашивает ввод нового остатка."""
-    car_number = callback.data.split(":")[1]
+    car_number = car_index.car_number(callback_data.car_id)
+    if not car_number:
+        await callback.answer("❌ Машина не найдена.")
+        return
     await state.update_data(selected_car=car_number)
 
     # Получаем ID сообщения для его редактирования
@@ -560,7 +1590,7 @@ async def enter_stock_value(callback: CallbackQuery, state: FSMContext):
 
     await state.set_state(AdminState.entering_stock)
 
-@dp.message(AdminState.entering_stock)
+@admin_router.message(AdminState.entering_stock)
 async def update_stock(message: Message, state: FSMContext):
     """Обновляет остаток в таблице."""
     new_stock = message.text.strip()
@@ -572,21 +1602,13 @@ async def update_stock(message: Message, state: FSMContext):
     data = await state.get_data()
     car_number = data["selected_car"]
 
-    sheet = client.open_by_key(SPREADSHEET_ID).worksheet("Состояние машины")
-    records = sheet.get_all_records(expected_headers=["Номер машины", "Остаток", "Дата изменения"])
-
-    row_to_update = None
-
-    # Поиск нужной строки в таблице
-    for index, record in enumerate(records, start=2):
-        if record["Номер машины"] == car_number:
-            row_to_update = index
-            break
-
-    if row_to_update:
-        # Обновление остатка и даты
-        sheet.update(f"B{row_to_update}", [[new_stock]])  # Обновляем остаток
-        sheet.update(f"C{row_to_update}", [[datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")]])  # Обновляем дату
+    # Строка машины — по карте строк каталога; при записи адрес сверяется с номером в столбце A
+    if locate_car(car_number):
+        # Обновление остатка (B) и даты (C)
+        sheets_outbox.enqueue(f"admin_stock:{message.chat.id}:{message.message_id}", [("cars", "car_update", {
+            "car": car_number,
+            "cells": {1: new_stock, 2: datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")},
+        })])
 
         # Отправляем новое сообщение с результатом обновления
         await message.answer(f"✅ Остаток для машины {car_number} обновлен на: {new_stock} л", reply_markup=admin_inline_go_menu)
@@ -598,114 +1620,140 @@ async def update_stock(message: Message, state: FSMContext):
 
 
 # =============== Получение инфы ======================
-from datetime import datetime
-from aiogram import types
-
-@dp.callback_query(F.data == "get_info")
+@admin_router.callback_query(F.data == "get_info")
 async def get_info(callback_query: types.CallbackQuery):
     """Выводит информацию о каждой машине за текущий день"""
     today = datetime.datetime.now().strftime("%Y-%m-%d")  # Форматируем дату ГГГГ-ДД-ММ
-    changes = changes_sheet.get_all_values()[1:]  # Данные из "Изменения" (без заголовков)
-    cars = cars_sheet.get_all_values()[1:]  # Получаем список всех машин
+    # Повторные нажатия без новых записей берут готовые строки из кэша
+    lines = await cached_report("daily_info", today, lambda: asyncio.to_thread(build_daily_info, today))
 
-    car_data = {car[0]: "информации нет" for car in cars}  # Заполняем словарь машинами
+    # Формируем текст сообщения: при большом парке — постранично
+    await render_pages(callback_query.message, f"📋 Информация по машинам за {today}:", lines, admin_inline_go_menu, edit=True)
 
-    last_entries = {}  # Словарь для хранения последней информации по каждой машине
 
-    for row in changes:
-        if len(row) < 5:
-            continue  # Пропускаем строки с недостаточным количеством данных
+@admin_router.callback_query(PagesCallback.filter())
+async def turn_text_page(callback: CallbackQuery, callback_data: PagesCallback):
+    """Перелистывание текста, выведенного через render_pages."""
+    cached = text_pages.get(callback_data.key)
+    if not cached or cached[0] != callback.message.chat.id:
+        await callback.answer("Список устарел, запросите его заново.")
+        return
+    _, pages, tail_rows = cached
+    page = min(max(callback_data.page, 0), len(pages) - 1)
+    await callback.answer()
+    await safe_edit(callback.message, pages[page], reply_markup=pages_keyboard(callback_data.key, page, len(pages), tail_rows))
 
-        fio = row[0]  # ФИО из 1-й ячейки
-        car_number = row[2]  # Номер машины из 3-й ячейки
-        stock = row[3]  # Физ. остаток из 4-й ячейки
-        date = row[4].split()[0] if row[4] else ""  # Дата без времени (5-я ячейка)
+@admin_router.callback_query(F.data == "admin_inline_menu")
+async def go_back_to_admin_menu(callback_query: CallbackQuery):
+    """Возвращает в админ-меню."""
+    await safe_edit(callback_query.message, "🔧 Панель администратора:", reply_markup=admin_inline_menu)
 
-        if date == today:  # Фильтруем по сегодняшнему дню
-            last_entries[car_number] = f"{fio}, {stock} л"  # Запоминаем последнюю запись
+# ========== Уведомление ==============
 
-    # Обновляем данные по машинам
-    for car_number, info in last_entries.items():
-        car_data[car_number] = info
+# Количество пользователей на одной странице выбора получателя
+USERS_PER_PAGE = 10
 
-    # Формируем текст сообщения
-    info_text = "\n".join([f"{car}: {info}" for car, info in car_data.items()])
 
-    await callback_query.message.edit_text(f"📋 Информация по машинам за {today}:\n{info_text}", reply_markup=admin_inline_go_menu)
+def get_recipients_keyboard(page: int):
+    """Клавиатура выбора получателя: группы рассылки, поиск и страница пользователей."""
+    users = user_index.get_users()
+    total_pages = max(1, (len(users) + USERS_PER_PAGE - 1) // USERS_PER_PAGE)
+    page = min(max(page, 1), total_pages)
 
-@dp.callback_query(F.data == "admin_inline_menu")
-async def go_back_to_admin_menu(callback_query: CallbackQuery):
-    """Возвращает в админ-меню."""
-    await callback_query.message.edit_text("🔧 Панель администратора:", reply_markup=admin_inline_menu)
+    # Рассылка по группам водителей
+    buttons = [
+        [InlineKeyboardButton(text=f"📣 {title.capitalize()}", callback_data=f"broadcast_segment:{segment}")]
+        for segment, title in BROADCAST_SEGMENTS.items()
+    ]
+    buttons.append([InlineKeyboardButton(text="🔍 Поиск по ФИО или телефону", callback_data="notify_search")])
 
-# ========== Уведомление ==============
-class AdminState(StatesGroup):
-    selecting_user = State()
-    sending_message = State()
-    waiting_for_message = State()
-    selecting_car = State() 
-    entering_stock = State()
+    start = (page - 1) * USERS_PER_PAGE
+    buttons += [
+        [InlineKeyboardButton(text=f"{name} ({phone})", callback_data=f"select_user:{tg_id}")]
+        for tg_id, name, phone in users[start:start + USERS_PER_PAGE]
+    ]
 
-import logging
+    # Кнопки перелистывания
+    navigation_buttons = []
+    if page > 1:
+        navigation_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"notify_page:{page - 1}"))
+    if total_pages > 1:
+        navigation_buttons.append(InlineKeyboardButton(text=f"{page}/{total_pages}", callback_data="notify_page:" + str(page)))
+    if page < total_pages:
+        navigation_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"notify_page:{page + 1}"))
+    if navigation_buttons:
+        buttons.append(navigation_buttons)
 
-# Настроим логирование
-logging.basicConfig(level=logging.DEBUG)
+    buttons.append([InlineKeyboardButton(text="Вернуться в админ-меню", callback_data="admin_inline_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-# Функция получения пользователей из первого листа таблицы
-def get_users_from_first_sheet():
-    try:
-        sheet = client.open("Client Database").sheet1  # Открываем первый лист
-        users = sheet.get_all_records()  # Получаем все строки в виде списка словарей
-        logging.debug(f"Получены пользователи: {users}")
-        return users
-    except Exception as e:
-        logging.error(f"Ошибка при получении пользователей: {e}")
-        return []
 
 # Обработчик кнопки "Уведомление"
-@dp.callback_query(F.data == "admin_notify")
+@admin_router.callback_query(F.data == "admin_notify")
 async def notify_users(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
        await callback.answer("⛔️ У вас нет доступа к этой функции.")
        return
-    users = get_users_from_first_sheet()
-    if not users:
-        await callback.message.answer("Не удалось получить список пользователей.")
-        return
 
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    await safe_edit(callback.message, "Выберите пользователя для отправки уведомления:", reply_markup=get_recipients_keyboard(1))
 
-    # Добавляем кнопки с ФИО пользователей
-    for user in users:
-        if "ФИО" in user and "Telegram ID" in user:
-            # Преобразуем Telegram ID в строку
-            tg_id_str = str(user["Telegram ID"])
-            keyboard.inline_keyboard.append([InlineKeyboardButton(text=user["ФИО"], callback_data=f"select_user:{tg_id_str}")])
+# Перелистывание списка получателей
+@admin_router.callback_query(F.data.startswith("notify_page:"))
+async def change_notify_page(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+       await callback.answer("⛔️ У вас нет доступа к этой функции.")
+       return
+
+    page = int(callback.data.split(":")[1])
+    await callback.answer()
+    await safe_edit(callback.message, "Выберите пользователя для отправки уведомления:", reply_markup=get_recipients_keyboard(page))
+
+# Поиск получателя по ФИО или телефону
+@admin_router.callback_query(F.data == "notify_search")
+async def ask_notify_search(callback: types.CallbackQuery, state: FSMContext):
+    if callback.from_user.id not in ADMIN_IDS:
+       await callback.answer("⛔️ У вас нет доступа к этой функции.")
+       return
 
-    if not keyboard.inline_keyboard:
-        await callback.message.answer("Нет пользователей для отправки уведомлений.")
+    await state.set_state(AdminState.searching_user)
+    await callback.answer()
+    await callback.message.answer("Введите начало ФИО или номера телефона:")
+
+@admin_router.message(AdminState.searching_user)
+async def search_notify_recipient(message: types.Message, state: FSMContext):
+    await state.clear()
+    found = user_index.search(message.text or "", limit=USERS_PER_PAGE)
+    if not found:
+        await message.answer("Никого не найдено.", reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔍 Искать снова", callback_data="notify_search")],
+            [InlineKeyboardButton(text="Вернуться в админ-меню", callback_data="admin_inline_menu")]
+        ]))
         return
 
-    await callback.message.answer("Выберите пользователя для отправки уведомления:", reply_markup=keyboard)
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{name} ({phone})", callback_data=f"select_user:{tg_id}")]
+        for tg_id, name, phone in found
+    ])
+    keyboard.inline_keyboard.append([InlineKeyboardButton(text="🔍 Искать снова", callback_data="notify_search")])
+    await message.answer(f"Найдено: {len(found)}. Выберите получателя:", reply_markup=keyboard)
 
 # Обработчик выбора пользователя
-@dp.callback_query(F.data.startswith("select_user:"))
+@admin_router.callback_query(F.data.startswith("select_user:"))
 async def select_user_for_message(callback: types.CallbackQuery, state: FSMContext):
     tg_id = callback.data.split(":")[1]  # Получаем Telegram ID пользователя
 
-    users = get_users_from_first_sheet()
-    # Преобразуем Telegram ID в строку при поиске
-    user = next((u for u in users if str(u.get("Telegram ID")) == tg_id), None)
+    user = user_index.get(tg_id)
 
     if user:
-        await state.update_data(user_tg_id=tg_id, user_name=user["ФИО"])
-        await callback.message.answer(f"Введите сообщение, которое хотите отправить пользователю {user['ФИО']}:")
+        user_name = user[1][1]  # ФИО — 2-й столбец
+        await state.update_data(user_tg_id=tg_id, user_name=user_name)
+        await callback.message.answer(f"Введите сообщение, которое хотите отправить пользователю {user_name}:")
         await state.set_state(AdminState.waiting_for_message)
     else:
         await callback.message.answer("Ошибка: Пользователь не найден.")
 
 # Обработчик ввода сообщения администратором
-@dp.message(AdminState.waiting_for_message)
+@admin_router.message(AdminState.waiting_for_message)
 async def send_message_to_user(message: types.Message, state: FSMContext):
     data = await state.get_data()
     user_tg_id = data.get("user_tg_id")
@@ -729,14 +1777,1073 @@ async def send_message_to_user(message: types.Message, state: FSMContext):
     await state.clear()  # Завершаем состояние
 
 # Обработчик нажатия на "Вернуться в главное меню"
-@dp.callback_query(lambda c: c.data == "go_main_menu")
+@driver_router.callback_query(F.data == "go_main_menu")
 async def go_main_menu(callback: types.CallbackQuery):
     await callback.message.answer("🏠 Главное меню", reply_markup=main_menu)
 
 
+# ========== Рассылка по группам водителей ==============
+BROADCAST_SEGMENTS = {
+    "confirmed": "всем подтверждённым водителям",
+    "on_trip": "всем водителям «В рейсе»",
+    "no_fuel_today": "не внёсшим остаток сегодня",
+}
+# Незавершённые рассылки хранятся в SQLite и продолжаются после перезапуска
+BROADCAST_JOBS_DB = os.getenv("BROADCAST_JOBS_DB", OUTBOX_DB)
+# Файл, в котором рассылки хранились раньше: при запуске переносится в базу
+BROADCAST_JOBS_FILE = os.getenv("BROADCAST_JOBS_FILE", "broadcast_jobs.json")
+# Сколько получателей обрабатывается между сохранениями прогресса
+BROADCAST_CHUNK = 25
+
+
+class BroadcastJobs:
+    """Задания рассылок в общей базе SQLite: {id: задание}.
+
+    При BOT_WORKERS > 1 задание создаёт процесс-обработчик, а выполняет
+    основной процесс (run_broadcast_jobs) — каждое задание пишется отдельной
+    строкой, так что процессы не затирают задания друг друга.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS broadcast_jobs (
+                id TEXT PRIMARY KEY,
+                job TEXT  -- JSON
+            );
+        """)
+
+    def save(self, job_id: str, job: dict):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO broadcast_jobs VALUES (?, ?)", (job_id, json.dumps(job, ensure_ascii=False))
+            )
+
+    def remove(self, job_id: str):
+        with self.db:
+            self.db.execute("DELETE FROM broadcast_jobs WHERE id = ?", (job_id,))
+
+    def all(self) -> dict:
+        return {job_id: json.loads(job) for job_id, job in self.db.execute("SELECT id, job FROM broadcast_jobs")}
+
+    def import_file(self, path: str):
+        """Переносит задания из JSON-файла прежних версий и удаляет файл."""
+        try:
+            with open(path, encoding="utf-8") as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.error(f"Не удалось прочитать {path}: {e}")
+            return
+        for job_id, job in jobs.items():
+            self.save(job_id, job)
+        os.remove(path)
+
+
+broadcast_jobs = BroadcastJobs(BROADCAST_JOBS_DB)
+# Рассылки, которые этот процесс уже выполняет
+running_broadcasts = set()
+
+
+def get_segment_recipients(segment: str):
+    """Возвращает Telegram ID водителей из выбранной группы."""
+    user_index.get_rows()
+    users = [row for _, row in user_index.by_id.values()]
+
+    if segment == "on_trip":
+        recipients = [u for u in users if len(u) > 5 and u[5] == "В рейсе"]
+    else:
+        recipients = [u for u in users if u[3] == "Подтвержден"]
+
+    if segment == "no_fuel_today":
+        today = datetime.datetime.now().strftime("%Y-%m-%d")
+        # В «Изменениях» водитель записан по телефону (2-й столбец), дата — в 5-м
+        reported = fuel_index.phones_since(today)
+        recipients = [u for u in recipients if u[0] not in reported]
+
+    return list(dict.fromkeys(u[4].strip() for u in recipients))
+
+
+async def report_broadcast_progress(job_id: str, job: dict, text: str):
+    """Обновляет сообщение с прогрессом рассылки у админа."""
+    if job.get("progress_message_id") is None:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=job["admin_id"], message_id=job["progress_message_id"])
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):  # После возобновления текст может совпасть
+            logging.warning(f"Не удалось обновить прогресс рассылки {job_id}: {e}")
+    except Exception as e:
+        logging.warning(f"Не удалось обновить прогресс рассылки {job_id}: {e}")
+
+
+async def run_broadcast(job_id: str, job: dict):
+    """Отправляет рассылку порциями, сохраняя прогресс после каждой порции."""
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Вернуться в главное меню", callback_data="go_main_menu")]
+    ])
+
+    while job["pending"]:
+        chunk = job["pending"][:BROADCAST_CHUNK]
+        sent, failed = await send_bulk([(int(tg_id), job["text"], keyboard) for tg_id in chunk])
+        job["sent"] += len(sent)
+        job["failed"] += len(failed)
+        job["pending"] = job["pending"][len(chunk):]
+        broadcast_jobs.save(job_id, job)
+
+        done = job["sent"] + job["failed"]
+        await report_broadcast_progress(
+            job_id, job,
+            f"📣 Рассылка {job_id}: {done}/{job['total']}\n📨 Доставлено: {job['sent']}, ⚠️ ошибок: {job['failed']}"
+        )
+
+    broadcast_jobs.remove(job_id)
+    running_broadcasts.discard(job_id)
+    await bot.send_message(
+        job["admin_id"],
+        f"✅ Рассылка {job_id} завершена.\n📨 Доставлено: {job['sent']} из {job['total']}, ⚠️ ошибок: {job['failed']}",
+        reply_markup=admin_inline_go_menu
+    )
+
+
+async def resume_broadcasts():
+    """Продолжает рассылки, прерванные перезапуском бота."""
+    broadcast_jobs.import_file(BROADCAST_JOBS_FILE)
+    for job_id, job in broadcast_jobs.all().items():
+        logging.info(f"Возобновляю рассылку {job_id}: осталось {len(job['pending'])} получателей")
+        try:
+            message = await bot.send_message(job["admin_id"], f"♻️ Рассылка {job_id} возобновлена после перезапуска.")
+            job["progress_message_id"] = message.message_id
+        except Exception as e:
+            # Админ недоступен или Telegram не отвечает — рассылку продолжаем без сообщения о прогрессе
+            logging.warning(f"Не удалось уведомить о возобновлении рассылки {job_id}: {e}")
+            job["progress_message_id"] = None
+        running_broadcasts.add(job_id)
+        run_in_background(run_broadcast(job_id, job))
+
+
+async def run_broadcast_jobs():
+    """Фоновая задача основного процесса: запускает рассылки, созданные любым процессом."""
+    await resume_broadcasts()
+    while True:
+        try:
+            for job_id, job in broadcast_jobs.all().items():
+                if job_id not in running_broadcasts:
+                    running_broadcasts.add(job_id)
+                    run_in_background(run_broadcast(job_id, job))
+        except Exception as e:
+            logging.error(f"Ошибка запуска рассылок: {e}")
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+
+
+@admin_router.callback_query(F.data.startswith("broadcast_segment:"))
+async def select_broadcast_segment(callback: types.CallbackQuery, state: FSMContext):
+    """Запрашивает текст рассылки для выбранной группы."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    segment = callback.data.split(":")[1]
+    if segment not in BROADCAST_SEGMENTS:
+        await callback.answer("❌ Неизвестная группа.")
+        return
+
+    await state.update_data(broadcast_segment=segment)
+    await state.set_state(AdminState.waiting_for_broadcast)
+    await callback.answer()
+    await callback.message.answer(f"Введите сообщение для рассылки {BROADCAST_SEGMENTS[segment]}:")
+
+
+@admin_router.message(AdminState.waiting_for_broadcast)
+async def start_broadcast(message: types.Message, state: FSMContext):
+    """Создаёт задание рассылки и запускает его в фоне."""
+    data = await state.get_data()
+    segment = data.get("broadcast_segment")
+    await state.clear()
+
+    recipients = get_segment_recipients(segment)
+    if not recipients:
+        await message.answer("Нет получателей в выбранной группе.", reply_markup=admin_inline_go_menu)
+        return
+
+    job_id = uuid.uuid4().hex[:8]
+    progress = await message.answer(f"📣 Рассылка {job_id}: 0/{len(recipients)}")
+    # Рассылку выполнит основной процесс (run_broadcast_jobs) — и при BOT_WORKERS > 1
+    broadcast_jobs.save(job_id, {
+        "segment": segment,
+        "text": message.text,
+        "admin_id": message.chat.id,
+        "progress_message_id": progress.message_id,
+        "pending": recipients,
+        "total": len(recipients),
+        "sent": 0,
+        "failed": 0,
+    })
+
+
+# ========== Массовое подтверждение заявок ==============
+# Сколько заявок помещается в одну клавиатуру (лимит Telegram — 100 кнопок)
+PENDING_LIMIT = 40
+
+
+async def get_pending_users():
+    """Возвращает заявки со статусом 'Ожидает': {telegram_id: (строка, ФИО, телефон)}."""
+    await user_index.refresh()
+    return {
+        tg_id: (row_number, row[1], row[0])
+        for tg_id, (row_number, row) in user_index.by_id.items() if row[3] == "Ожидает"
+    }
+
+
+def get_pending_keyboard(pending: dict, selected: list):
+    """Клавиатура со списком заявок и отметками выбранных."""
+    buttons = [
+        [InlineKeyboardButton(
+            text=f"{'☑️' if tg_id in selected else '⬜️'} {name} ({phone})",
+            callback_data=f"pending_toggle:{tg_id}"
+        )]
+        for tg_id, (_, name, phone) in list(pending.items())[:PENDING_LIMIT]
+    ]
+    buttons.append([InlineKeyboardButton(text="☑️ Выбрать все", callback_data="pending_select_all")])
+    buttons.append([
+        InlineKeyboardButton(text="✅ Подтвердить", callback_data="pending_bulk:confirm"),
+        InlineKeyboardButton(text="❌ Отклонить", callback_data="pending_bulk:block")
+    ])
+    buttons.append([InlineKeyboardButton(text="Вернуться в админ-меню", callback_data="admin_inline_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def pending_text(pending: dict, selected: list):
+    text = f"👥 Заявок на подтверждение: {len(pending)}, выбрано: {len(selected)}"
+    if len(pending) > PENDING_LIMIT:
+        text += f"\nПоказаны первые {PENDING_LIMIT}, остальные появятся после обработки."
+    return text
+
+
+@admin_router.callback_query(F.data == "admin_pending")
+async def show_pending_users(callback: CallbackQuery, state: FSMContext):
+    """Показывает все заявки со статусом 'Ожидает' с возможностью выбора."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    pending = await get_pending_users()  # Из кэша пользователей, без отдельного чтения листа
+    if not pending:
+        await callback.message.edit_text("✅ Нет заявок, ожидающих подтверждения.", reply_markup=admin_inline_go_menu)
+        return
+
+    # Снимок заявок хранится в состоянии, чтобы отметки не перечитывали таблицу
+    await state.update_data(pending=pending, pending_selected=[])
+    await safe_edit(callback.message, pending_text(pending, []), reply_markup=get_pending_keyboard(pending, []))
+
+
+@admin_router.callback_query(F.data.startswith("pending_toggle:") | (F.data == "pending_select_all"))
+async def toggle_pending_user(callback: CallbackQuery, state: FSMContext):
+    """Отмечает или снимает отметку с заявки."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    data = await state.get_data()
+    pending = data.get("pending")
+    if not pending:
+        await callback.answer("Список устарел, откройте его заново.")
+        return
+
+    selected = data.get("pending_selected", [])
+    if callback.data == "pending_select_all":
+        visible = list(pending)[:PENDING_LIMIT]
+        selected = [] if len(selected) == len(visible) else visible
+    else:
+        tg_id = callback.data.split(":")[1]
+        if tg_id in selected:
+            selected.remove(tg_id)
+        elif tg_id in pending:
+            selected.append(tg_id)
+
+    await state.update_data(pending_selected=selected)
+    await callback.answer()
+    await safe_edit(callback.message, pending_text(pending, selected), reply_markup=get_pending_keyboard(pending, selected))
+
+
+@admin_router.callback_query(F.data.startswith("pending_bulk:"))
+async def bulk_pending_action(callback: CallbackQuery, state: FSMContext):
+    """Подтверждает или отклоняет выбранные заявки одной пакетной записью."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    action = callback.data.split(":")[1]
+    data = await state.get_data()
+    pending = data.get("pending", {})
+    selected = [tg_id for tg_id in data.get("pending_selected", []) if tg_id in pending]
+    if not selected:
+        await callback.answer("Не выбрано ни одной заявки.")
+        return
+
+    # Заявки, которые другой админ уже обработал после открытия списка, не трогаем
+    selected = [tg_id for tg_id in selected if (entry := locate_user(tg_id)) and entry[1][3] == "Ожидает"]
+    if not selected:
+        await state.update_data(pending=None, pending_selected=[])
+        await callback.answer("Выбранные заявки уже обработаны.")
+        return
+
+    # Все изменения статусов — одним batchUpdate; строки находятся по Telegram ID
+    # при записи, и столбец E проверяется тем же запросом (checked_rows_update).
+    # Уведомления уходят только тем, чьи строки действительно записаны (notify_bulk_pending)
+    await state.update_data(pending=None, pending_selected=[])
+    await callback.answer()
+    progress = await callback.message.edit_text(f"⏳ Заявок в обработке: {len(selected)}. Уведомления уйдут после записи в таблицу...")
+    cells = {3: "Подтвержден", 5: "Свободен"} if action == "confirm" else {3: "Отклонено"}
+    sheets_outbox.enqueue(f"pending:{callback.id}", [("users", "users_bulk_update", {
+        "users": {tg_id: cells for tg_id in selected},
+        "expect": {3: "Ожидает"},
+        "notify": {
+            "action": action,
+            "chat_id": callback.message.chat.id,
+            "message_id": progress.message_id if isinstance(progress, Message) else callback.message.message_id,
+        },
+    })])
+
+
+async def notify_bulk_pending(payload: dict, written: list):
+    """Уведомляет водителей, чьи заявки записаны пакетной операцией, и обновляет итог у админа."""
+    notify = payload["notify"]
+    if notify["action"] == "confirm":
+        messages = [(int(tg_id), "✅ Ваш вход подтвержден! Добро пожаловать!", main_menu) for tg_id in written]
+        result = "✅ Подтверждено"
+    else:
+        messages = [(int(tg_id), "🚫 Ваш доступ был отклонен администратором.", None) for tg_id in written]
+        result = "🚫 Отклонено"
+    sent, failed = await send_bulk(messages, metric="bulk_confirm")
+
+    text = f"{result} заявок: {len(written)}\n📨 Уведомлено: {len(sent)}"
+    if failed:
+        text += f"\n⚠️ Не доставлено: {len(failed)}"
+    skipped = len(payload["users"]) - len(written)
+    if skipped:
+        text += f"\n⏭ Пропущено: {skipped} (заявку уже обработали или строку не удалось найти)"
+    try:
+        await bot.edit_message_text(
+            text, chat_id=notify["chat_id"], message_id=notify["message_id"], reply_markup=admin_inline_go_menu
+        )
+    except Exception as e:
+        logging.warning(f"Не удалось обновить итог обработки заявок: {e}")
+
+
+# ========== История заправок ==============
+@admin_router.message(Command("car_history"))
+async def car_history_command(message: Message, command: CommandObject):
+    """/car_history <номер> [N] — последние N показаний по машине."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    # В номере могут быть пробелы («А123ВС 77»): сначала ищем всю строку как номер,
+    # и только если не нашлось — считаем последнее число количеством записей
+    args = (command.args or "").split()
+    limit = 10
+    found = car_index.search(" ".join(args), limit=1) if args else []
+    if not found and len(args) > 1 and args[-1].isdigit():
+        limit = int(args.pop())
+        found = car_index.search(" ".join(args), limit=1)
+    if not found:
+        await message.answer("Использование: /car_history <номер машины> [количество]")
+        return
+
+    car_number = found[0]
+    entries = fuel_index.car_history(car_number, min(limit, 50))
+    if not entries:
+        await message.answer(f"🚙 {car_number}: записей нет.")
+        return
+    lines = [f"{ts} — {name}, {stock:g} л" if stock is not None else f"{ts} — {name}" for ts, name, stock in entries]
+    await message.answer(f"🚙 {car_number}, последние показания:\n" + "\n".join(lines))
+
+
+@admin_router.message(Command("driver_week"))
+async def driver_week_command(message: Message, command: CommandObject):
+    """/driver_week <ФИО или телефон> — записи водителя с начала недели."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    found = user_index.search(command.args or "", limit=1) if command.args else []
+    if not found:
+        await message.answer("Использование: /driver_week <ФИО или телефон>")
+        return
+
+    _, name, phone = found[0]
+    today = datetime.date.today()
+    week_start = (today - datetime.timedelta(days=today.weekday())).isoformat()
+    entries = fuel_index.driver_entries(phone, week_start)
+    if not entries:
+        await message.answer(f"👤 {name}: с {week_start} записей нет.")
+        return
+    lines = [f"{ts} — {car}, {stock:g} л" if stock is not None else f"{ts} — {car}" for ts, car, stock in entries]
+    await render_pages(message, f"👤 {name}, записи с {week_start}:", lines)
+
+
+# ========== Аналитика расхода ==============
+# Расхождение остатка админа и показаний водителя, после которого машина помечается (л)
+DISCREPANCY_THRESHOLD = float(os.getenv("DISCREPANCY_THRESHOLD", "5"))
+
+
+def month_bounds(month: str):
+    """'ГГГГ-ММ' -> ('ГГГГ-ММ-01', первое число следующего месяца)."""
+    start = datetime.datetime.strptime(month, "%Y-%m").date()
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return start.isoformat(), end.isoformat()
+
+
+def admin_stock_by_car():
+    """Остатки, внесённые админом в «Состояние машины»: {номер: литры}."""
+    stocks = {}
+    for car, (_, row) in car_index.by_number.items():
+        try:
+            stocks[car] = float(row[1].replace(",", "."))
+        except (IndexError, ValueError):
+            pass
+    return stocks
+
+
+async def build_month_analytics(month: str):
+    """Сводка расхода за месяц: столбцы fuel_analytics.car_summary.
+
+    Журнал читается в потоке, а сводка считается в процессе пула: массивы
+    передаются через общую память, цикл событий водителей не блокируется.
+    """
+    since, until = month_bounds(month)
+    log = await asyncio.to_thread(fuel_index.fuel_log, since, until)
+    car_index.get_rows()
+    return await run_in_report_pool(log, fuel_analytics.summary_from_shared, admin_stock_by_car())
+
+
+def format_month_analytics(month: str, summary: dict):
+    """Заголовок и строки сводки для render_pages."""
+    if not len(summary["car"]):
+        return f"📊 {month}: показаний нет.", []
+
+    # Сначала машины с наибольшим расхождением
+    order = np.argsort(-np.nan_to_num(np.abs(summary["discrepancy"])), kind="stable")
+    lines = []
+    for i in order:
+        line = (f"🚙 {summary['car'][i]}: израсходовано {summary['consumed'][i]:g} л, "
+                f"заправлено {summary['refilled'][i]:g} л, последнее показание {summary['last_stock'][i]:g} л")
+        discrepancy = summary["discrepancy"][i]
+        if not np.isnan(discrepancy):  # Остаток админа известен
+            line += f", у админа {summary['admin_stock'][i]:g} л"
+            if abs(discrepancy) >= DISCREPANCY_THRESHOLD:
+                line += f" ⚠️ расхождение {discrepancy:+g} л"
+        lines.append(line)
+    return f"📊 Расход топлива за {month}:", lines
+
+
+@admin_router.message(Command("analytics"))
+async def analytics_command(message: Message, command: CommandObject):
+    """/analytics [ГГГГ-ММ] — расход, заправки и расхождения по машинам за месяц."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    month = (command.args or "").strip() or datetime.date.today().strftime("%Y-%m")
+    try:
+        summary = await cached_report("month_analytics", month, lambda: build_month_analytics(month))
+    except ValueError:
+        await message.answer("Использование: /analytics [ГГГГ-ММ]")
+        return
+    await render_pages(message, *format_month_analytics(month, summary))
+
+
+# ========== Тяжёлые отчёты вне цикла событий ==============
+# Процессов для расчёта сводок
+REPORT_PROCESSES = int(os.getenv("REPORT_PROCESSES", "2"))
+
+# (отчёт, период, версия данных) -> asyncio.Future с результатом
+report_cache = LRUCache(maxsize=64)
+report_pool = None
+
+
+def get_report_pool():
+    """Пул процессов создаётся при первом тяжёлом отчёте."""
+    global report_pool
+    if report_pool is None:
+        # fork: процессу пула не нужно заново импортировать бота — spawn выполнил бы
+        # модуль целиком, с подключением к таблицам; в Windows fork нет
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        report_pool = ProcessPoolExecutor(REPORT_PROCESSES, mp_context=multiprocessing.get_context(method))
+    return report_pool
+
+
+async def run_in_report_pool(log, func, *args):
+    """Выполняет func(handle, *args) в пуле, передав журнал через общую память."""
+    global report_pool
+    shm, handle = fuel_analytics.share_log(log)
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_report_pool(), func, handle, *args)
+    except BrokenProcessPool:
+        report_pool = None  # Процесс пула упал — при следующем отчёте пул создастся заново
+        raise
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+async def report_data_version():
+    """Версия данных отчётов: индекс заправок и каталог машин.
+    Каталог по истечении TTL читается в потоке, а индекс перестраивается в цикле событий."""
+    await car_index.refresh()
+    return fuel_index.version(), car_index.version
+
+
+async def cached_report(name: str, period, build):
+    """Результат build() для (name, period) при текущей версии данных.
+
+    Пока данные не менялись, повторный запрос отдаёт готовый результат;
+    одновременные запросы ждут один и тот же расчёт. Ошибки не кэшируются.
+    """
+    key = (name, period, await report_data_version())
+    future = report_cache.get(key)
+    if future is None:
+        METRICS["report_cache_miss"] += 1
+        future = asyncio.ensure_future(build())
+        report_cache[key] = future
+
+        def forget_failed(done):
+            if done.cancelled() or done.exception() is not None:
+                report_cache.pop(key, None)
+
+        future.add_done_callback(forget_failed)
+    else:
+        METRICS["report_cache_hit"] += 1
+    return await asyncio.shield(future)
+
+
+def build_daily_info(day: str):
+    """Строки «машина: последняя запись за день» из индекса заправок (выполняется в потоке)."""
+    car_data = {car[0]: "информации нет" for car in car_index.rows if car and car[0]}
+    # "~" больше любого символа времени: интервал захватывает весь день
+    for _, name, _, car_number, stock in fuel_index.iter_entries(day, day + "~"):
+        car_data[car_number] = f"{name}, {stock:g} л" if stock is not None else name
+    return [f"{car}: {info}" for car, info in car_data.items()]
+
+
+# ========== Отчёты ==============
+try:
+    from openpyxl import Workbook
+except ImportError:  # Без openpyxl отчёты выгружаются только в CSV
+    Workbook = None
+
+REPORT_DIR = os.getenv("REPORT_DIR", "reports")
+# Время ночной выгрузки по Москве, ЧЧ:ММ
+NIGHTLY_REPORT_TIME = os.getenv("NIGHTLY_REPORT_TIME", "00:30")
+REPORT_PERIODS = {"day": "День", "week": "Неделя", "month": "Месяц"}
+REPORT_HEADER = ["Дата", "ФИО", "Телефон", "Номер машины", "Физ. остаток", "Израсходовано с начала периода, л"]
+SUMMARY_HEADER = ["Номер машины", "Показаний", "Израсходовано, л", "Заправлено, л", "Последнее показание, л"]
+# Сколько строк индекса обрабатывать за раз при сборке отчёта
+REPORT_CHUNK_ROWS = 5000
+
+
+def report_bounds(period: str, day: datetime.date):
+    """Границы отчёта, содержащего day: (since, until, метка для имени файла)."""
+    if period == "day":
+        start, end, label = day, day + datetime.timedelta(days=1), day.isoformat()
+    elif period == "week":
+        start = day - datetime.timedelta(days=day.weekday())
+        end = start + datetime.timedelta(days=7)
+        label = f"{start.isoformat()}_week"
+    elif period == "month":
+        start = day.replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        label = start.strftime("%Y-%m")
+    else:
+        raise ValueError(f"Неизвестный период отчёта: {period}")
+    return start.isoformat(), end.isoformat(), label
+
+
+def stream_report_rows(since: str, until: str, totals: dict):
+    """Отдаёт строки отчёта по одной и попутно копит итоги по машинам в totals.
+
+    totals: {машина: [показаний, израсходовано, заправлено, последнее показание]}.
+    Последний столбец строки — нарастающий итог расхода машины на момент показания.
+    Строки читаются из индекса кусками по REPORT_CHUNK_ROWS, так что память не растёт
+    с размером журнала.
+    """
+    entries = fuel_index.iter_entries(since, until)
+    while chunk := list(itertools.islice(entries, REPORT_CHUNK_ROWS)):
+        yield from report_chunk_rows(chunk, totals)
+
+
+def report_chunk_rows(chunk: list, totals: dict):
+    """Строки куска отчёта с нарастающим итогом расхода.
+
+    Итог считает fuel_analytics.running_consumption по показаниям куска,
+    сгруппированным по машине; totals продолжает итоги предыдущих кусков.
+    """
+    # Устойчивая сортировка: внутри машины показания остаются в порядке времени
+    readings = sorted((i for i, row in enumerate(chunk) if row[4] is not None), key=lambda i: chunk[i][3])
+    # Время для нарастающего итога не нужно — порядок задан сортировкой
+    log = fuel_analytics.log_from_sorted((chunk[i][3], 0, chunk[i][4]) for i in readings)
+    running = fuel_analytics.running_consumption(log, {car: (total[3], total[1]) for car, total in totals.items()})
+    by_row = dict(zip(readings, running.tolist()))
+    # Строка без остатка получает итог последнего показания машины до неё
+    current = {car: total[1] for car, total in totals.items()}
+
+    starts = np.flatnonzero(np.diff(log.car_codes, prepend=-1))
+    for start, end in zip(starts, np.append(starts[1:], len(log)) - 1):
+        car = log.cars[log.car_codes[start]]
+        count, consumed, refilled, last_stock = totals.get(car, [0, 0.0, 0.0, float(log.stock[start])])
+        # Изменение остатка за кусок = заправлено − израсходовано
+        chunk_consumed = float(running[end]) - consumed
+        chunk_refilled = float(log.stock[end]) - last_stock + chunk_consumed
+        totals[car] = [count + end - start + 1, float(running[end]), refilled + chunk_refilled, float(log.stock[end])]
+
+    for i, row in enumerate(chunk):
+        if i in by_row:
+            current[row[3]] = by_row[i]
+        yield [*row, current.get(row[3], 0.0)]
+
+
+def write_report(period: str, day: datetime.date, fmt: str) -> str:
+    """Пишет отчёт в файл и возвращает путь. Выполняется в потоке (asyncio.to_thread).
+
+    Строки идут из индекса курсором прямо в файл: CSV пишется построчно,
+    XLSX — через openpyxl в режиме write_only, так что память не растёт
+    с размером журнала. Время показаний — локальное время сервера
+    (datetime.now() при записи), поэтому и закрытость периода проверяется по
+    локальной дате. Файл, собранный после конца периода, помечается «_final»
+    и отдаётся повторно без пересборки; отчёт за незакрытый период
+    пересобирается при каждом запросе.
+    """
+    since, until, label = report_bounds(period, day)
+    if fmt == "xlsx" and Workbook is None:
+        fmt = "csv"
+    os.makedirs(REPORT_DIR, exist_ok=True)
+    closed = until <= datetime.date.today().isoformat()
+    path = os.path.join(REPORT_DIR, f"fuel_{label}{'_final' if closed else ''}.{fmt}")
+    if closed and os.path.exists(path):
+        return path
+
+    totals = {}
+    tmp_path = path + ".tmp"
+    if fmt == "xlsx":
+        workbook = Workbook(write_only=True)
+        entries = workbook.create_sheet("Показания")
+        entries.append(REPORT_HEADER)
+        for row in stream_report_rows(since, until, totals):
+            entries.append(row)
+        summary = workbook.create_sheet("Сводка")
+        summary.append(SUMMARY_HEADER)
+        for car, total in sorted(totals.items()):
+            summary.append([car, *total])
+        workbook.save(tmp_path)
+    else:
+        # utf-8-sig и «;» — чтобы файл сразу открывался в русском Excel
+        with open(tmp_path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(REPORT_HEADER)
+            writer.writerows(stream_report_rows(since, until, totals))
+    os.replace(tmp_path, path)
+    return path
+
+
+def get_reports_keyboard():
+    formats = ["csv", "xlsx"] if Workbook is not None else ["csv"]
+    keyboard = [
+        [InlineKeyboardButton(text=f"{title} · {fmt.upper()}", callback_data=ReportCallback(period=period, fmt=fmt).pack())
+         for fmt in formats]
+        for period, title in REPORT_PERIODS.items()
+    ]
+    keyboard.append([InlineKeyboardButton(text="Вернуться в админ-меню", callback_data="admin_inline_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+@admin_router.callback_query(F.data == "admin_reports")
+async def show_reports_menu(callback: CallbackQuery):
+    """Меню выгрузки отчётов по показаниям."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+    await safe_edit(
+        callback.message,
+        "📑 Выберите период отчёта (текущий день, неделя или месяц):", reply_markup=get_reports_keyboard()
+    )
+
+
+@admin_router.callback_query(ReportCallback.filter())
+async def send_report(callback: CallbackQuery, callback_data: ReportCallback):
+    """Формирует отчёт за текущий период и отправляет его файлом."""
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+    await callback.answer("⏳ Формирую отчёт...")
+    try:
+        path = await asyncio.to_thread(write_report, callback_data.period, datetime.date.today(), callback_data.fmt)
+    except Exception as e:
+        logging.error(f"Ошибка формирования отчёта: {e}")
+        await callback.message.answer("❌ Не удалось сформировать отчёт.")
+        return
+    await callback.message.answer_document(FSInputFile(path), caption=f"📑 {os.path.basename(path)}")
+
+
+async def send_report_to_admins(path: str):
+    """Рассылает готовый файл отчёта админам."""
+    for admin_id in ADMIN_IDS:
+        try:
+            await bot.send_document(admin_id, FSInputFile(path), caption=f"🌙 Ночной отчёт: {os.path.basename(path)}")
+            METRICS["nightly_report_sent"] += 1
+        except Exception as e:
+            logging.warning(f"Не удалось отправить отчёт админу {admin_id}: {e}")
+
+
+async def schedule_nightly_reports():
+    """Каждую ночь в NIGHTLY_REPORT_TIME (МСК) собирает отчёт за прошедший день,
+    после воскресенья — за прошедшую неделю, после последнего числа — за месяц.
+
+    Срабатывает по московскому времени, но «вчера» считается по локальной дате
+    сервера — в ней записаны показания, так что отчёт всегда за закрытый период."""
+    hour, minute = map(int, NIGHTLY_REPORT_TIME.split(":"))
+    while True:
+        now = datetime.datetime.now(MSK_TZ)
+        run_at = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if run_at <= now:
+            run_at += datetime.timedelta(days=1)
+        await asyncio.sleep((run_at - now).total_seconds())
+
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        periods = ["day"]
+        if yesterday.weekday() == 6:
+            periods.append("week")
+        if (yesterday + datetime.timedelta(days=1)).day == 1:
+            periods.append("month")
+        fmt = "xlsx" if Workbook is not None else "csv"
+        for period in periods:
+            try:
+                path = await asyncio.to_thread(write_report, period, yesterday, fmt)
+                logging.info(f"Ночной отчёт сформирован: {path}")
+                await send_report_to_admins(path)
+            except Exception as e:
+                logging.error(f"Ошибка ночного отчёта ({period}): {e}")
+
+
+# ========== Профилирование ==============
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Период опроса стеков в режиме sampling (сек)
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# Длительность профилирования по сигналу SIGUSR1 (сек)
+PROFILE_SIGNAL_SECONDS = int(os.getenv("PROFILE_SIGNAL_SECONDS", "30"))
+PROFILE_MAX_SECONDS = 600
+profiling_active = False
+
+
+def registered_handler_names():
+    """Имена функций всех зарегистрированных обработчиков."""
+    return {
+        handler.callback.__name__
+        for router in (driver_router, registration_router, admin_router)
+        for observer in router.observers.values()
+        for handler in observer.handlers
+    }
+
+
+def sample_stacks(seconds: float, interval: float):
+    """Каждые interval секунд снимает стеки всех потоков (цикл событий, пул потоков).
+
+    Возвращает Counter свёрнутых стеков «поток;внешняя;...;внутренняя» — формат
+    flamegraph.pl и speedscope.
+    """
+    stacks = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(thread_id, str(thread_id)))
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def profile_name(extension: str):
+    """Имя файла профиля; pid различает профили процессов-обработчиков, снятые одновременно."""
+    return f"profile-{datetime.datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}.{extension}"
+
+
+async def run_sampling_profile(seconds: float):
+    """Сэмплирующий профиль: пишет .folded и возвращает (путь, топ обработчиков)."""
+    stacks = await asyncio.to_thread(sample_stacks, seconds, PROFILE_INTERVAL)
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, profile_name("folded"))
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.items():
+            f.write(f"{stack} {count}\n")
+
+    # Суммарное время обработчика — все сэмплы, где он есть в стеке
+    handler_names = registered_handler_names()
+    totals = Counter()
+    for stack, count in stacks.items():
+        for name in {frame.split(" (")[0] for frame in stack.split(";")} & handler_names:
+            totals[name] += count
+    return path, [(name, count * PROFILE_INTERVAL) for name, count in totals.most_common(10)]
+
+
+async def run_cprofile(seconds: float):
+    """cProfile потока цикла событий: пишет .pstats и возвращает (путь, топ обработчиков)."""
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, profile_name("pstats"))
+    profiler.dump_stats(path)
+
+    handler_names = registered_handler_names()
+    cumulative = Counter()
+    for (_, _, name), (_, _, _, cumtime, _) in pstats.Stats(profiler).stats.items():
+        if name in handler_names:
+            cumulative[name] += cumtime
+    return path, cumulative.most_common(10)
+
+
+async def run_profile(seconds: float, mode: str = "sampling"):
+    """Профилирует работающего бота seconds секунд; одновременно — только один запуск."""
+    global profiling_active
+    if profiling_active:
+        raise RuntimeError("профилирование уже запущено")
+    profiling_active = True
+    try:
+        if mode == "cprofile":
+            return await run_cprofile(seconds)
+        return await run_sampling_profile(seconds)
+    finally:
+        profiling_active = False
+
+
+def format_profile_report(path: str, top: list):
+    lines = [f"{name}: {seconds:.2f} с" for name, seconds in top] or ["обработчики не попали в профиль"]
+    return f"📈 Профиль сохранён: {path}\nТоп обработчиков по суммарному времени:\n" + "\n".join(lines)
+
+
+@admin_router.message(Command("profile"))
+async def profile_command(message: Message, command: CommandObject):
+    """/profile [секунды] [sampling|cprofile] — профилирует бота и присылает результат."""
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔️ У вас нет доступа к этой функции.")
+        return
+
+    args = (command.args or "").split()
+    seconds = int(args[0]) if args and args[0].isdigit() else 30
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    mode = args[1] if len(args) > 1 and args[1] in ("sampling", "cprofile") else "sampling"
+
+    await message.answer(f"⏱ Профилирование ({mode}) на {seconds} с...")
+    try:
+        path, top = await run_profile(seconds, mode)
+    except RuntimeError as e:
+        await message.answer(f"❌ Ошибка: {e}.")
+        return
+    await message.answer_document(FSInputFile(path), caption=format_profile_report(path, top)[:1024])
+
+
+async def profile_on_signal():
+    """Профилирование по SIGUSR1 — результат пишется в журнал."""
+    try:
+        path, top = await run_profile(PROFILE_SIGNAL_SECONDS)
+        logging.info(format_profile_report(path, top))
+    except RuntimeError as e:
+        logging.warning(f"Профилирование по сигналу пропущено: {e}")
+
+
+def install_profile_signal():
+    """kill -USR1 <pid> запускает профилирование без перезапуска (нет в Windows).
+
+    При BOT_WORKERS > 1 сигнал ставится в каждом процессе: pid обработчика есть в журнале запуска.
+    """
+    if hasattr(signal, "SIGUSR1"):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, lambda: run_in_background(profile_on_signal()))
+
+
+# ========== Задержка цикла событий и метрики ==============
+# Как часто измерять задержку планирования (сек)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+# Блокировка цикла дольше порога считается медленным колбэком (сек)
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", "0.5"))
+# Порт HTTP-эндпоинта /metrics (0 — выключен)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин, как в Prometheus."""
+
+    def __init__(self, buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            self.counts[index] += 1
+
+    def snapshot(self):
+        """Состояние для передачи между процессами (объекты __mp_main__ не распаковываются в основном)."""
+        return list(self.counts), self.count, self.sum
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        histogram = cls()
+        histogram.counts, histogram.count, histogram.sum = snapshot
+        return histogram
+
+    def render(self, name: str, process: str):
+        """Строки гистограммы с меткой процесса (без строки # TYPE)."""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{process="{process}",le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{process="{process}",le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{process="{process}"}} {self.sum}')
+        lines.append(f'{name}_count{{process="{process}"}} {self.count}')
+        return lines
+
+
+HISTOGRAMS = {"loop_lag_seconds": Histogram()}
+# Последние снимки метрик процессов-обработчиков: {номер: (счётчики, {имя: снимок гистограммы})}
+WORKER_METRICS = {}
+# Как часто процесс-обработчик отправляет свои метрики основному (сек)
+METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", "5"))
+
+
+class LoopLagMonitor:
+    """Измеряет задержку планирования цикла событий и ловит блокирующие колбэки.
+
+    Корутина засыпает на interval и замеряет, насколько позже проснулась. Отдельный
+    поток-сторож следит за её «пульсом»: если цикл не отвечает дольше порога,
+    сторож записывает в журнал стек потока цикла — то место, где он завис.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = SLOW_CALLBACK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.loop_thread_id = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        threading.Thread(target=self.watchdog, name="loop-watchdog", daemon=True).start()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            HISTOGRAMS["loop_lag_seconds"].observe(lag)
+            self.last_beat = time.monotonic()
+            if lag > self.threshold:
+                METRICS["slow_callbacks"] += 1
+
+    def watchdog(self):
+        reported_beat = None
+        while True:
+            time.sleep(self.threshold / 2)
+            beat = self.last_beat
+            if time.monotonic() - beat > self.interval + self.threshold and beat != reported_beat:
+                reported_beat = beat  # Один стек на каждую блокировку
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен"
+                logging.warning(f"Цикл событий заблокирован дольше {self.threshold} с:\n{stack}")
+
+
+def render_metrics():
+    """Счётчики и гистограммы в текстовом формате Prometheus.
+
+    Счётчики процессов-обработчиков суммируются с основным процессом,
+    гистограммы выводятся по каждому процессу с меткой process.
+    """
+    counters = Counter(METRICS)
+    histograms = [("main", HISTOGRAMS)]
+    for index, (worker_counters, worker_histograms) in sorted(WORKER_METRICS.items()):
+        counters.update(worker_counters)
+        histograms.append((
+            f"worker-{index}",
+            {name: Histogram.from_snapshot(snapshot) for name, snapshot in worker_histograms.items()},
+        ))
+    lines = []
+    for name, value in sorted(counters.items()):
+        lines += [f"# TYPE bot_{name} counter", f"bot_{name} {value}"]
+    for name in HISTOGRAMS:
+        lines.append(f"# TYPE bot_{name} histogram")
+        for process, process_histograms in histograms:
+            if name in process_histograms:
+                lines += process_histograms[name].render(f"bot_{name}", process)
+    return "\n".join(lines) + "\n"
+
+
+async def push_worker_metrics(index: int, metrics_queue):
+    """Процесс-обработчик периодически отправляет снимок своих метрик основному процессу."""
+    while True:
+        await asyncio.sleep(METRICS_PUSH_INTERVAL)
+        metrics_queue.put((
+            index, dict(METRICS), {name: histogram.snapshot() for name, histogram in HISTOGRAMS.items()}
+        ))
+
+
+async def collect_worker_metrics(metrics_queue):
+    """Основной процесс принимает снимки метрик обработчиков до сигнала остановки (None).
+
+    После перезапуска обработчика его счётчики начинаются с нуля — для
+    Prometheus это обычный сброс счётчика.
+    """
+    while True:
+        snapshot = await asyncio.to_thread(metrics_queue.get)
+        if snapshot is None:
+            return
+        index, counters, histograms = snapshot
+        WORKER_METRICS[index] = (counters, histograms)
+
+
+async def metrics_handler(request: web.Request):
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+
+async def start_metrics_server():
+    """Запускает HTTP-эндпоинт /metrics, если задан METRICS_PORT."""
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", METRICS_PORT).start()
+    logging.info(f"Метрики доступны на :{METRICS_PORT}/metrics")
+
+
+def install_loop_monitoring():
+    """Запускает монитор задержки; с ASYNCIO_DEBUG=1 включает и отладку asyncio,
+    которая пишет в журнал каждый колбэк дольше порога (дорого, не для постоянной работы)."""
+    loop = asyncio.get_running_loop()
+    if os.getenv("ASYNCIO_DEBUG") == "1":
+        loop.set_debug(True)
+        loop.slow_callback_duration = SLOW_CALLBACK_THRESHOLD
+    run_in_background(LoopLagMonitor().run())
+
+
 # ================== Таймер ===============
-import pytz
-import datetime
 # Часовой пояс Москвы
 MSK_TZ = pytz.timezone("Europe/Moscow")
 
@@ -775,7 +2882,7 @@ async def send_fuel_reminder(bot: Bot):
                         reply_markup=keyboard
                     )
                 except Exception as e:
-                    print(f"Ошибка при отправке сообщения {telegram_id}: {e}")
+                    logging.warning(f"Ошибка при отправке сообщения {telegram_id}: {e}")
 
         # Ждем 15 минут перед следующей проверкой
         await asyncio.sleep(1 * 30)
@@ -785,15 +2892,161 @@ async def schedule_fuel_reminder(bot: Bot):
     while True:
         await send_fuel_reminder(bot)
 
+# ==================== РОУТЕРЫ ====================
+driver_router.callback_query.filter(callback_route(
+    exact={"view_cars", "back_to_main_menu", "main_menu", "enter_physical_stock", "go_main_menu"},
+    prefixes=("car:info:", "car:stock:", "cars:")
+))
+registration_router.callback_query.filter(callback_route(prefixes=("confirm_user:", "block_user:")))
+admin_router.callback_query.filter(callback_route(
+    exact={"admin_update_stock", "get_info", "admin_inline_menu", "admin_notify", "notify_search",
+           "admin_pending", "pending_select_all", "admin_reports"},
+    prefixes=("car:admin:", "cars:admin:", "pages:", "notify_page:", "select_user:", "broadcast_segment:", "pending_toggle:", "pending_bulk:",
+              "report:")
+))
+# Водительский раздел — самый частый, поэтому проверяется первым
+dp.include_routers(driver_router, registration_router, admin_router)
+
+# ==================== НЕСКОЛЬКО ПРОЦЕССОВ ====================
+# Число процессов-обработчиков; 0 или 1 — всё в одном процессе, как раньше
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0"))
+# Сколько апдейтов может ждать в очереди одного процесса, прежде чем приём притормозит
+WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", "1000"))
+POLLING_TIMEOUT = 30
+
+
+async def process_updates(update_queue):
+    """Цикл процесса-обработчика: апдейты разных чатов — параллельно, одного чата — по очереди."""
+    await process_in_chat_order(
+        lambda: asyncio.to_thread(update_queue.get), lambda update: dp.feed_raw_update(bot, update)
+    )
+    if background_tasks:
+        await asyncio.wait(list(background_tasks))
+
+
+async def worker_main(index: int, update_queue, metrics_queue, send_slot):
+    try:
+        logging.info(f"Процесс-обработчик {index} запущен (pid {os.getpid()})")
+        broadcast_limiter.share(send_slot)
+        # Обработчики работают здесь — монитор цикла и профилирование по SIGUSR1 нужны в каждом процессе
+        install_profile_signal()
+        install_loop_monitoring()
+        if METRICS_PORT:
+            run_in_background(push_worker_metrics(index, metrics_queue))
+        await process_updates(update_queue)
+    finally:
+        await bot.session.close()
+
+
+def worker_process(index: int, update_queue, metrics_queue, send_slot):
+    """Точка входа процесса-обработчика (multiprocessing spawn заново импортирует модуль)."""
+    asyncio.run(worker_main(index, update_queue, metrics_queue, send_slot))
+
+
+class WorkerPool:
+    """Процессы-обработчики с отдельной очередью апдейтов у каждого.
+
+    Общие для всех процессов: очередь снимков метрик и слот лимита отправки сообщений.
+    """
+
+    def __init__(self, size: int):
+        self.context = multiprocessing.get_context("spawn")  # Одинаково в Linux и Windows, без fork с открытыми сокетами
+        self.queues = [self.context.Queue(maxsize=WORKER_QUEUE_SIZE) for _ in range(size)]
+        self.metrics_queue = self.context.Queue()
+        self.send_slot = self.context.Value("d", 0.0)
+        self.processes = [None] * size
+
+    def start(self, index: int):
+        process = self.context.Process(
+            target=worker_process, args=(index, self.queues[index], self.metrics_queue, self.send_slot),
+            name=f"bot-worker-{index}", daemon=True,
+        )
+        process.start()
+        self.processes[index] = process
+
+    def start_all(self):
+        for index in range(len(self.queues)):
+            self.start(index)
+
+    async def watch(self):
+        """Перезапускает упавшие процессы; их очереди с необработанными апдейтами сохраняются."""
+        while True:
+            await asyncio.sleep(5)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logging.error(f"Процесс-обработчик {index} завершился с кодом {process.exitcode}, перезапуск")
+                    METRICS["worker_restarts"] += 1
+                    self.start(index)
+
+    async def dispatch(self, update: dict):
+        update_queue = self.queues[shard_index(update, len(self.queues))]
+        try:
+            update_queue.put_nowait(update)
+        except queue.Full:  # Обработчик не успевает — ждём, не читая новые апдейты
+            await asyncio.to_thread(update_queue.put, update)
+
+    def stop(self, timeout: float = 10):
+        for update_queue in self.queues:
+            update_queue.put(None)
+        for process in self.processes:
+            process.join(timeout)
+        self.metrics_queue.put(None)
+
+
+async def run_supervisor(pool: WorkerPool):
+    """Принимает апдейты long polling'ом и раздаёт их процессам по чату."""
+    pool.start_all()
+    run_in_background(pool.watch())
+    if METRICS_PORT:
+        run_in_background(collect_worker_metrics(pool.metrics_queue))
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    try:
+        while True:
+            try:
+                # Сервер держит запрос до POLLING_TIMEOUT — таймаут сессии считается сверх него
+                updates = await bot.get_updates(
+                    offset=offset, timeout=POLLING_TIMEOUT, allowed_updates=allowed_updates,
+                    request_timeout=int(bot.session.timeout + POLLING_TIMEOUT),
+                )
+            except Exception as e:
+                logging.error(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(5)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                await pool.dispatch(update.model_dump(mode="json", by_alias=True, exclude_unset=True))
+                METRICS["updates_dispatched"] += 1
+    finally:
+        await asyncio.to_thread(pool.stop)
+
+
 # ==================== ЗАПУСК БОТА ====================
 async def main():
+    pool = WorkerPool(BOT_WORKERS) if BOT_WORKERS > 1 else None
+    if pool is not None:
+        broadcast_limiter.share(pool.send_slot)  # Рассылки основного процесса — в том же лимите, что и обработчики
     try:
-        print("Бот запущен...")
+        logging.info("Бот запущен...")
         asyncio.create_task(schedule_fuel_reminder(bot))  # Запуск фоновой задачи
-        await dp.start_polling(bot)
+        run_in_background(schedule_nightly_reports())
+        run_in_background(run_broadcast_jobs())
+        install_profile_signal()
+        install_loop_monitoring()
+        seed_anomaly_detector()
+        run_in_background(sync_fuel_index_periodically())
+        run_in_background(apply_outbox())
+        run_in_background(watch_stock_readings())
+        await start_metrics_server()
+        if pool is not None:
+            # Фоновые задачи остаются здесь, апдейты обрабатывают процессы-обработчики
+            await run_supervisor(pool)
+        else:
+            await dp.start_polling(bot)
     finally:
+        if report_pool is not None:
+            report_pool.shutdown(cancel_futures=True)
         await bot.session.close()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main())
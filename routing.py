@@ -0,0 +1,21 @@
+"""Предфильтр роутеров по callback_data.
+
+Модуль не зависит от бота и таблиц: его использует mashina_bot.py для
+разделов driver/registration/admin, а bench_routing.py измеряет на нём
+стоимость маршрутизации.
+"""
+
+
+def callback_route(exact=(), prefixes=()):
+    """Предфильтр роутера: точные callback_data ищутся в множестве, остальные — по префиксу.
+
+    Если callback не относится к разделу, диспетчер пропускает роутер целиком,
+    не проверяя фильтры каждого его обработчика.
+    """
+    exact = frozenset(exact)
+    prefixes = tuple(prefixes)
+
+    def check(callback) -> bool:
+        return callback.data in exact or (callback.data or "").startswith(prefixes)
+
+    return check
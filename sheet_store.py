@@ -0,0 +1,523 @@
+"""Кэш листов Google Sheets, очередь записей в таблицы и запись с проверкой адреса строки.
+
+Модуль не обращается к Google Sheets сам: листы (объекты gspread или их
+обёртки) передаются в классы и функции, поэтому всё здесь можно проверить
+с поддельными листами, без сети.
+"""
+import asyncio
+import bisect
+import json
+import logging
+import re
+import sqlite3
+import time
+import zlib
+from collections import Counter
+
+
+class CachedSheet:
+    """Кэширует строки листа (без заголовка) на ttl секунд.
+
+    version увеличивается, когда после перечитывания данные изменились.
+    Производные индексы (on_change) собираются заново и подменяются целиком,
+    поэтому читатель видит либо прежнюю, либо новую версию, а не пустой словарь.
+    """
+
+    def __init__(self, worksheet, ttl: float = 60):
+        self.worksheet = worksheet
+        self.ttl = ttl
+        self.rows = []
+        self.version = 0
+        self._loaded_at = None
+        self.on_change()
+
+    def stale(self) -> bool:
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def get_rows(self):
+        if self.stale():
+            self.store(self.worksheet.get_all_values()[1:])
+        return self.rows
+
+    async def refresh(self):
+        """Как get_rows, но для цикла событий: лист читается в потоке, а строки
+        и индексы подменяются уже в цикле — там же, где их читают обработчики."""
+        if self.stale():
+            values = await asyncio.to_thread(self.worksheet.get_all_values)
+            self.store(values[1:])
+        return self.rows
+
+    def store(self, rows):
+        """Кладёт в кэш прочитанные строки листа (без заголовка)."""
+        if rows != self.rows:
+            self.rows = rows
+            self.version += 1
+            self.on_change()
+        self._loaded_at = time.monotonic()
+
+    def invalidate(self):
+        """Помечает кэш устаревшим — следующее обращение перечитает лист."""
+        self._loaded_at = None
+
+    def loaded_rows(self):
+        """Строки без перечитывания по TTL: лист читается, только если кэш пуст
+        или сброшен invalidate(). Для записи по адресу строки, которая сама
+        проверяет, что адрес не устарел."""
+        if self._loaded_at is None:
+            return self.get_rows()
+        return self.rows
+
+    def reload_if_older(self, seconds: float) -> bool:
+        """Перечитывает лист, если он загружен больше seconds назад; True — если перечитал.
+        Для промахов по loaded_rows(): строку могли добавить вручную или в другом процессе."""
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at <= seconds:
+            return False
+        self.invalidate()
+        self.get_rows()
+        return True
+
+    def patch_row(self, row_number: int, cells: dict):
+        """Вносит в кэш ячейки {столбец с 0: значение}, записанные ботом, без перечитывания листа."""
+        index = row_number - 2
+        if not 0 <= index < len(self.rows):
+            self.invalidate()
+            return
+        row = self.rows[index]
+        for column, value in cells.items():
+            row.extend([""] * (column + 1 - len(row)))
+            row[column] = str(value)
+        self.version += 1
+        self.on_change()
+
+    def add_appended(self, response: dict, values: list):
+        """Добавляет в кэш строку по ответу append_row; если строка не последняя — сбрасывает кэш."""
+        match = re.search(r"![A-Z]+(\d+)", response.get("updates", {}).get("updatedRange", ""))
+        if self._loaded_at is None or not match or int(match.group(1)) != len(self.rows) + 2:
+            self.invalidate()
+            return
+        self.rows.append([str(value) for value in values])
+        self.version += 1
+        self.on_change()
+
+    def on_change(self):
+        """Перестраивает производные индексы после изменения данных."""
+
+
+class UserIndex(CachedSheet):
+    """Пользователи по Telegram ID и отсортированный индекс для поиска по ФИО и телефону."""
+
+    def on_change(self):
+        by_id = {}
+        users = []
+        for row_number, row in enumerate(self.rows, start=2):
+            if len(row) > 4 and row[4].strip().isdigit():
+                tg_id = row[4].strip()
+                by_id[tg_id] = (row_number, row)
+                users.append((tg_id, row[1], row[0]))
+        users.sort(key=lambda u: u[1].lower())  # (tg_id, ФИО, телефон)
+
+        # Ключи поиска: ФИО с каждого слова (фамилия, имя, отчество) и цифры телефона
+        keys = []
+        for tg_id, name, phone in users:
+            words = name.lower().split()
+            keys += [(" ".join(words[i:]), tg_id) for i in range(len(words))]
+            digits = re.sub(r"\D", "", phone)
+            if digits:
+                keys += [(digits, tg_id), (digits[1:], tg_id)]  # С кодом страны и без
+        keys.sort()
+        self.by_id, self.users, self.search_keys = by_id, users, keys
+
+    def get_users(self):
+        self.get_rows()
+        return self.users
+
+    def get(self, tg_id):
+        """Возвращает (номер строки, строка) пользователя или None."""
+        self.get_rows()
+        return self.by_id.get(str(tg_id))
+
+    def search(self, query: str, limit: int = 20):
+        """Поиск по префиксу ФИО (любого слова) или телефона."""
+        self.get_rows()
+        query = " ".join(query.lower().split())
+        if re.fullmatch(r"[+\d\s()-]+", query):
+            query = re.sub(r"\D", "", query)
+            if query.startswith("8"):
+                query = "7" + query[1:]  # 8XXXXXXXXXX -> 7XXXXXXXXXX
+        if not query:
+            return []
+
+        found = {}
+        start = bisect.bisect_left(self.search_keys, (query,))
+        for key, tg_id in self.search_keys[start:]:
+            if not key.startswith(query) or len(found) >= limit:
+                break
+            found[tg_id] = None
+        return [u for u in self.users if u[0] in found]
+
+
+# Кириллические буквы, совпадающие по написанию с латинскими на номерах
+PLATE_LOOKALIKES = str.maketrans("АВЕКМНОРСТУХ", "ABEKMHOPCTYX")
+
+
+def normalize_plate(value: str) -> str:
+    """Приводит номер к единому виду: верхний регистр, латиница, без пробелов и дефисов."""
+    return re.sub(r"[\s-]", "", value.upper()).translate(PLATE_LOOKALIKES)
+
+
+class CarIndex(CachedSheet):
+    """Машины по номеру, префиксный и триграммный индексы по нормализованному номеру.
+
+    Каждой машине выдаётся короткий ID для callback_data. ID вычисляется из номера,
+    поэтому не меняется при перестановке строк и перезапуске бота.
+    """
+
+    def __init__(self, worksheet, ttl: float = 60):
+        self.car_ids = {}  # номер -> ID
+        self.numbers_by_id = {}  # ID -> номер
+        super().__init__(worksheet, ttl)
+
+    def on_change(self):
+        by_number = {}
+        trigrams = {}
+        keys = []
+        for row_number, row in enumerate(self.rows, start=2):
+            if not row or not row[0].strip():
+                continue
+            car = row[0]
+            by_number[car] = (row_number, row)
+            if car not in self.car_ids:
+                car_id = zlib.crc32(car.encode())
+                while car_id in self.numbers_by_id:  # Коллизия — берём следующий свободный
+                    car_id += 1
+                self.car_ids[car] = car_id
+                self.numbers_by_id[car_id] = car
+            plate = normalize_plate(car)
+            keys.append((plate, car))
+            for i in range(len(plate) - 2):
+                trigrams.setdefault(plate[i:i + 3], set()).add(car)
+        keys.sort()
+        self.by_number, self.trigrams, self.prefix_keys = by_number, trigrams, keys
+        # Готовые страницы клавиатур для текущей версии каталога: (действие, страница) -> кнопки
+        self.pages = {}
+
+    def get(self, car_number: str):
+        """Возвращает (номер строки, строка) машины или None."""
+        self.get_rows()
+        return self.by_number.get(car_number)
+
+    def car_number(self, car_id: int):
+        """Номер машины по ID из callback_data (None, если машина удалена)."""
+        car = self.numbers_by_id.get(car_id)
+        return car if self.get(car) else None
+
+    def search(self, query: str, limit: int = 20):
+        """Ищет машины: сначала совпадения по началу номера, затем по подстроке."""
+        self.get_rows()
+        query = normalize_plate(query)
+        if not query:
+            return list(self.by_number)[:limit]
+
+        found = {}
+        start = bisect.bisect_left(self.prefix_keys, (query,))
+        for plate, car in self.prefix_keys[start:]:
+            if not plate.startswith(query) or len(found) >= limit:
+                break
+            found[car] = None
+
+        # Подстрока: пересечение множеств по всем триграммам запроса
+        if len(query) >= 3 and len(found) < limit:
+            candidates = set.intersection(*(self.trigrams.get(query[i:i + 3], set()) for i in range(len(query) - 2)))
+            for car in sorted(candidates):
+                if len(found) >= limit:
+                    break
+                if query in normalize_plate(car):
+                    found.setdefault(car, None)
+        return list(found)
+
+
+class SheetsOutbox:
+    """Журнал изменений таблиц в SQLite: сначала запись на диск, затем — в Google Sheets.
+
+    Обработчик ставит операции в очередь и сразу отвечает пользователю;
+    apply_pending (в боте — из фоновой задачи apply_outbox) применяет их по
+    порядку. Операции одного вызова enqueue записываются одной транзакцией,
+    поэтому после падения процесса применяются все вместе. Повторный enqueue с тем же ключом ничего не добавляет.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 8, retention_hours: float = 72, metrics: Counter = None):
+        self.max_attempts = max_attempts  # Сколько попыток, прежде чем отложить операцию как ошибочную
+        self.retention_hours = retention_hours  # Сколько хранить применённые операции (ключи идемпотентности)
+        self.metrics = metrics if metrics is not None else Counter()
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = FULL;  -- транзакция подтверждается после fsync
+            CREATE TABLE IF NOT EXISTS ops (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                key TEXT UNIQUE,  -- ключ идемпотентности
+                sheet TEXT,  -- имя листа (ключ OUTBOX_SHEETS бота)
+                op TEXT,  -- append (append_row), car_update и user_update (checked_row_update),
+                          -- users_bulk_update (checked_rows_update)
+                payload TEXT,  -- JSON
+                status TEXT DEFAULT 'pending',  -- pending, done, failed
+                attempts INTEGER DEFAULT 0,
+                error TEXT,
+                created_at REAL,
+                applied_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS ops_status ON ops (status, id);
+            CREATE TABLE IF NOT EXISTS readers (
+                name TEXT PRIMARY KEY,  -- кто читает новые операции (take_new)
+                last_id INTEGER  -- последняя прочитанная операция
+            );
+        """)
+        self.wakeup = asyncio.Event()
+
+    def enqueue(self, key: str, ops) -> bool:
+        """Ставит операции [(лист, op, payload), ...] в очередь; False — ключ уже был."""
+        now = time.time()
+        with self.db:
+            cursor = self.db.executemany(
+                "INSERT OR IGNORE INTO ops (key, sheet, op, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(f"{key}#{i}", sheet_name, op, json.dumps(payload, ensure_ascii=False), now)
+                 for i, (sheet_name, op, payload) in enumerate(ops)]
+            )
+        if cursor.rowcount <= 0:
+            self.metrics["outbox_duplicates"] += 1
+            return False
+        self.metrics["outbox_enqueued"] += cursor.rowcount
+        self.wakeup.set()
+        return True
+
+    def take_new(self, reader: str, limit: int = 200):
+        """Операции, поставленные после прошлого вызова reader, — в любом статусе.
+
+        Позиция читателя хранится в той же базе, так что после перезапуска
+        операции не выдаются повторно. Новый читатель начинает с первой
+        неприменённой операции. Возвращает [(id, лист, op, payload), ...].
+        """
+        with self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO readers (name, last_id) "
+                "SELECT ?, COALESCE(MAX(id), 0) FROM ops WHERE status = 'done'", (reader,)
+            )
+            last_id = self.db.execute("SELECT last_id FROM readers WHERE name = ?", (reader,)).fetchone()[0]
+            rows = self.db.execute(
+                "SELECT id, sheet, op, payload FROM ops WHERE id > ? ORDER BY id LIMIT ?", (last_id, limit)
+            ).fetchall()
+            if rows:
+                self.db.execute("UPDATE readers SET last_id = ? WHERE name = ?", (rows[-1][0], reader))
+        return [(op_id, sheet_name, op, json.loads(payload)) for op_id, sheet_name, op, payload in rows]
+
+    def pending(self, limit: int = 50):
+        return self.db.execute(
+            "SELECT id, sheet, op, payload, attempts FROM ops WHERE status = 'pending' ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+
+    def start_attempt(self, op_id: int):
+        """Отмечает попытку до вызова API: после падения операция считается, возможно, применённой."""
+        with self.db:
+            self.db.execute("UPDATE ops SET attempts = attempts + 1 WHERE id = ?", (op_id,))
+
+    def finish(self, op_id: int, status: str = "done", error: str = None):
+        with self.db:
+            self.db.execute(
+                "UPDATE ops SET status = ?, error = ?, applied_at = ? WHERE id = ?", (status, error, time.time(), op_id)
+            )
+
+    def record_error(self, op_id: int, error: str):
+        with self.db:
+            self.db.execute("UPDATE ops SET error = ? WHERE id = ?", (error, op_id))
+
+    def compact(self):
+        """Удаляет применённые операции старше retention_hours и сжимает WAL."""
+        before = time.time() - self.retention_hours * 3600
+        with self.db:
+            removed = self.db.execute("DELETE FROM ops WHERE status = 'done' AND applied_at < ?", (before,)).rowcount
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        if removed:
+            logging.info(f"Очередь записей: удалено применённых операций {removed}")
+
+    async def backoff(self, attempts: int):
+        """Пауза перед повтором операции после attempts неудачных попыток."""
+        await asyncio.sleep(min(2 ** attempts, 60))
+
+    async def apply_pending(self, apply, already_applied, after) -> bool:
+        """Применяет очередь по порядку. False — очередь пуста или операция ждёт повтора.
+
+        apply(лист, op, payload) — один вызов API (выполняется в потоке);
+        already_applied(лист, op, payload) — корутина: дошла ли до таблицы прошлая
+        попытка операции, прерванная падением процесса (для append — повторять нельзя);
+        after(лист, op, payload, результат) — обновление локальных индексов.
+        LookupError из apply — записи больше нет, ValueError — операцию нельзя применить
+        (неизвестный op, неверный payload): повтор не поможет, и операция сразу
+        откладывается как ошибочная.
+        """
+        batch = self.pending()
+        for op_id, sheet_name, op, payload, attempts in batch:
+            payload = json.loads(payload)
+            if attempts and await already_applied(sheet_name, op, payload):
+                self.finish(op_id)
+                after(sheet_name, op, payload, {})
+                continue
+
+            self.start_attempt(op_id)
+            try:
+                result = await asyncio.to_thread(apply, sheet_name, op, payload)
+            except (LookupError, ValueError) as e:
+                # Записи больше нет в листе или операция неприменима — повтор не поможет
+                self.finish(op_id, "failed", str(e))
+                self.metrics["outbox_failed"] += 1
+                logging.error(f"Операция очереди {op_id} ({sheet_name}/{op}) не применена: {e}")
+                continue
+            except Exception as e:
+                if attempts + 1 >= self.max_attempts:
+                    # Не блокируем очередь навсегда: операция остаётся в журнале для разбора
+                    self.finish(op_id, "failed", str(e))
+                    self.metrics["outbox_failed"] += 1
+                    logging.error(f"Операция очереди {op_id} ({sheet_name}/{op}) не применена: {e}")
+                    continue
+                self.record_error(op_id, str(e))
+                logging.warning(f"Ошибка применения операции очереди {op_id}, повтор: {e}")
+                # Следующие операции ждут: порядок записей сохраняется
+                await self.backoff(attempts)
+                return False
+
+            self.finish(op_id)
+            self.metrics["outbox_applied"] += 1
+            after(sheet_name, op, payload, result)
+        return bool(batch)
+
+    async def drain(self, timeout: float = 10.0) -> bool:
+        """Ждёт применения операций, поставленных до вызова (в том числе другими процессами)."""
+        last = self.db.execute("SELECT MAX(id) FROM ops WHERE status = 'pending'").fetchone()[0]
+        if last is None:
+            return True
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if not self.db.execute("SELECT 1 FROM ops WHERE status = 'pending' AND id <= ? LIMIT 1", (last,)).fetchone():
+                return True
+            await asyncio.sleep(0.1)
+        return False
+
+
+class RowMoved(Exception):
+    """Строка по адресу из кэша оказалась другой записью; запись отменена, кэш сброшен.
+
+    written — {ключ: номер строки} записей того же batchUpdate, прошедших проверку.
+    """
+
+    def __init__(self, message: str, written: dict = None):
+        super().__init__(message)
+        self.written = written or {}
+
+
+def cell_request(worksheet, row: int, column: int, value) -> dict:
+    """updateCells для одной ячейки (row с 1, column с 0); строки пишутся как есть, как RAW."""
+    return {"updateCells": {
+        "start": {"sheetId": worksheet.id, "rowIndex": row - 1, "columnIndex": column},
+        "rows": [{"values": [{"userEnteredValue": {"stringValue": str(value)}}]}],
+        "fields": "userEnteredValue",
+    }}
+
+
+def a1_cell(row: int, column: int) -> str:
+    """Адрес ячейки в нотации A1 (row и column с 1)."""
+    letters = ""
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return f"{letters}{row}"
+
+
+def checked_row_update(spreadsheet, worksheet, cache: CachedSheet, locate, key: str, key_column: int, cells: dict,
+                       metrics: Counter = None):
+    """Пишет ячейки cells {столбец: значение} в строку записи key с проверкой адреса.
+
+    Возвращает номер строки. Номер берётся из карты строк кэша (locate), без чтения листа. Тот же
+    batchUpdate возвращает ячейку ключа после записи (includeSpreadsheetInResponse),
+    так что проверка не стоит отдельного запроса. В Sheets нет условной записи:
+    если строку сдвинули (вставка или удаление строк), прежние значения чужой
+    строки восстанавливаются по снимку кэша до записи (пустая строка очищается,
+    о строке, которой в кэше не было, пишется ошибка в журнал), кэш сбрасывается,
+    и бросается RowMoved — очередь повторит операцию по обновлённой карте.
+    """
+    if locate(key) is None:
+        raise LookupError(f"{key} нет в листе «{worksheet.title}»")
+    return checked_rows_update(spreadsheet, worksheet, cache, locate, key_column, {key: cells}, metrics=metrics)[key]
+
+
+def checked_rows_update(spreadsheet, worksheet, cache: CachedSheet, locate, key_column: int, updates: dict,
+                        expect: dict = None, metrics: Counter = None):
+    """То же, что checked_row_update, для нескольких записей {ключ: ячейки} одним batchUpdate.
+
+    Возвращает {ключ: номер строки} для записанных строк. Ключи, которых нет в
+    листе или чья строка по кэшу не совпадает с expect {столбец: значение}
+    (её уже изменили), пропускаются.
+    """
+    rows = {}
+    for key, cells in updates.items():
+        entry = locate(key)
+        if entry is None:
+            continue
+        row, values = entry
+        if expect and any((values[column] if column < len(values) else "") != value for column, value in expect.items()):
+            continue
+        rows[key] = row
+    if not rows:
+        return {}
+
+    # Значения строк по кэшу до записи: после неё locate может перечитать лист
+    # и вернуть уже записанные ботом значения, а восстанавливать нужно прежние
+    snapshot = {
+        values[key_column].strip(): list(values)
+        for values in cache.rows if len(values) > key_column and values[key_column].strip()
+    }
+    response = spreadsheet.batch_update({
+        "requests": [
+            cell_request(worksheet, rows[key], column, value)
+            for key in rows for column, value in updates[key].items()
+        ],
+        "includeSpreadsheetInResponse": True,
+        "responseRanges": [f"'{worksheet.title}'!{a1_cell(row, key_column + 1)}" for row in rows.values()],
+        "responseIncludeGridData": True,
+    })
+
+    # Одна GridData на каждый диапазон ответа, в порядке responseRanges
+    grids = [grid for sheet_data in response.get("updatedSpreadsheet", {}).get("sheets", [])
+             for grid in sheet_data.get("data", [])]
+    conflicts = []
+    for index, key in enumerate(rows):
+        actual = ""
+        for row_data in (grids[index].get("rowData", []) if index < len(grids) else []):
+            for cell in row_data.get("values", []):
+                actual = cell.get("formattedValue", "")
+        if actual.strip() != str(key).strip():
+            conflicts.append((key, actual))
+    if not conflicts:
+        return rows
+
+    if metrics is not None:
+        metrics["row_conflicts"] += len(conflicts)
+    compensation = []
+    for key, actual in conflicts:
+        row = rows[key]
+        previous = snapshot.get(actual.strip()) if actual else []
+        if previous is not None:
+            # Чужой строке возвращаем значения, которые она имела по кэшу; пустую строку
+            # (записи сдвинулись вверх) очищаем, чтобы не оставить в ней обрывок записи
+            compensation += [
+                cell_request(worksheet, row, column, previous[column] if column < len(previous) else "")
+                for column in updates[key]
+            ]
+        else:
+            logging.error(f"Строка {row} листа «{worksheet.title}» ({actual!r}) перезаписана вместо {key}, проверьте вручную")
+    if compensation:
+        spreadsheet.batch_update({"requests": compensation})
+    cache.invalidate()
+    conflicted = {key for key, _ in conflicts}
+    raise RowMoved(
+        "; ".join(f"{key}: строка {rows[key]} занята {actual!r}" for key, actual in conflicts),
+        written={key: row for key, row in rows.items() if key not in conflicted},
+    )
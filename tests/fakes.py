@@ -0,0 +1,60 @@
+"""Поддельные лист и таблица Google Sheets в памяти — для тестов без сети."""
+import copy
+import re
+
+
+class FakeWorksheet:
+    def __init__(self, title: str, rows, sheet_id: int = 0):
+        self.title = title
+        self.id = sheet_id
+        self.rows = [list(row) for row in rows]  # С заголовком, как в таблице
+        self.reads = 0
+
+    def get_all_values(self):
+        self.reads += 1
+        return copy.deepcopy(self.rows)
+
+    def append_row(self, values):
+        self.rows.append([str(value) for value in values])
+        return {"updates": {"updatedRange": f"'{self.title}'!A{len(self.rows)}:E{len(self.rows)}"}}
+
+    def cell(self, row: int, column: int) -> str:
+        """Значение ячейки (row с 1, column с 0)."""
+        if row > len(self.rows):
+            return ""
+        values = self.rows[row - 1]
+        return values[column] if column < len(values) else ""
+
+    def set_cell(self, row: int, column: int, value: str):
+        while len(self.rows) < row:
+            self.rows.append([])
+        values = self.rows[row - 1]
+        values.extend([""] * (column + 1 - len(values)))
+        values[column] = value
+
+
+class FakeSpreadsheet:
+    """batchUpdate с updateCells и ответом по responseRanges, как у Sheets API."""
+
+    def __init__(self, *worksheets):
+        self.worksheets = {worksheet.id: worksheet for worksheet in worksheets}
+        self.requests = []
+
+    def batch_update(self, body: dict):
+        self.requests.append(body)
+        for request in body["requests"]:
+            update = request["updateCells"]
+            worksheet = self.worksheets[update["start"]["sheetId"]]
+            value = update["rows"][0]["values"][0]["userEnteredValue"]["stringValue"]
+            worksheet.set_cell(update["start"]["rowIndex"] + 1, update["start"]["columnIndex"], value)
+        if not body.get("includeSpreadsheetInResponse"):
+            return {}
+
+        data = []
+        for response_range in body["responseRanges"]:
+            title, column, row = re.fullmatch(r"'(.+)'!([A-Z]+)(\d+)", response_range).groups()
+            worksheet = next(w for w in self.worksheets.values() if w.title == title)
+            value = worksheet.cell(int(row), ord(column) - ord("A"))
+            # Для пустой ячейки Sheets не возвращает rowData
+            data.append({"rowData": [{"values": [{"formattedValue": value}]}]} if value else {})
+        return {"updatedSpreadsheet": {"sheets": [{"data": data}]}}
@@ -0,0 +1,77 @@
+import datetime
+
+import numpy as np
+
+from fuel_analytics import (
+    StockAnomalyDetector, car_summary, log_from_sorted, running_consumption, share_log, summary_from_shared,
+)
+
+HOUR = 3600
+
+
+def sample_log():
+    # (машина, unix-время, остаток), отсортировано по машине и времени, как выборка индекса
+    return log_from_sorted([
+        ("A111AA", 0, 80.0), ("A111AA", HOUR, 60.0), ("A111AA", 2 * HOUR, 90.0), ("A111AA", 3 * HOUR, 70.0),
+        ("B222BB", 0, 50.0), ("B222BB", HOUR, 45.0),
+    ])
+
+
+def test_log_from_sorted_codes_cars_in_order():
+    log = sample_log()
+    assert list(log.cars) == ["A111AA", "B222BB"]
+    assert list(log.car_codes) == [0, 0, 0, 0, 1, 1]
+    assert log.ts[1] == np.datetime64(HOUR, "s")
+    assert len(log_from_sorted([])) == 0
+
+
+def test_car_summary_splits_consumption_and_refills():
+    summary = car_summary(sample_log(), {"A111AA": 75.0})
+    assert list(summary["car"]) == ["A111AA", "B222BB"]
+    assert list(summary["readings"]) == [4, 2]
+    assert list(summary["consumed"]) == [40.0, 5.0]
+    assert list(summary["refilled"]) == [30.0, 0.0]
+    assert list(summary["last_stock"]) == [70.0, 45.0]
+    assert summary["discrepancy"][0] == 5.0
+    assert np.isnan(summary["discrepancy"][1])  # Админ остаток не вносил
+
+
+def test_running_consumption_restarts_per_car():
+    assert list(running_consumption(sample_log())) == [0.0, 20.0, 20.0, 40.0, 0.0, 5.0]
+    assert len(running_consumption(log_from_sorted([]))) == 0
+
+
+def test_running_consumption_continues_previous_chunk():
+    log = sample_log()
+    # До куска у B222BB был остаток 55 л и итог 7 л; A111AA в прошлых кусках не встречалась
+    assert list(running_consumption(log, {"B222BB": (55.0, 7.0)})) == [0.0, 20.0, 20.0, 40.0, 12.0, 17.0]
+
+
+def test_summary_from_shared_matches_in_process_summary():
+    log = sample_log()
+    shm, handle = share_log(log)
+    try:
+        shared = summary_from_shared(handle, {"A111AA": 75.0})
+    finally:
+        shm.close()
+        shm.unlink()
+    expected = car_summary(log, {"A111AA": 75.0})
+    for column in ("readings", "consumed", "refilled", "last_stock"):
+        assert list(shared[column]) == list(expected[column])
+
+
+def test_anomaly_detector_flags_unusual_drop_after_warmup():
+    detector = StockAnomalyDetector(capacity=100, factor=3, min_liters=10, warmup=3)
+    start = datetime.datetime(2026, 1, 1)
+    stock = 90.0
+    for hour in range(1, 5):  # Обычный расход — 2 л/ч
+        stock -= 2
+        assert detector.check("A111AA", start + datetime.timedelta(hours=hour), stock) == []
+    assert detector.check("A111AA", start + datetime.timedelta(hours=5), stock - 30)
+    # Повторная загрузка старого показания статистику не трогает
+    assert detector.check("A111AA", start + datetime.timedelta(hours=1), 10.0) == []
+
+
+def test_anomaly_detector_flags_reading_outside_tank():
+    detector = StockAnomalyDetector(capacity=100)
+    assert detector.check("A111AA", datetime.datetime(2026, 1, 1), 150.0)
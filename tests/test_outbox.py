@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+import pytest
+
+from sheet_store import RowMoved, SheetsOutbox
+
+
+@pytest.fixture
+def outbox(tmp_path):
+    outbox = SheetsOutbox(str(tmp_path / "outbox.db"), max_attempts=3)
+
+    async def no_backoff(attempts):
+        pass
+
+    outbox.backoff = no_backoff
+    return outbox
+
+
+class Sheets:
+    """Применяет операции очереди к списку строк; fail — сколько раз подряд падать на значении."""
+
+    def __init__(self, fail=None, error=RowMoved):
+        self.rows = []
+        self.fail = dict(fail or {})
+        self.error = error
+        self.after = []
+
+    def apply(self, sheet_name, op, payload):
+        value = payload["values"][0]
+        if self.fail.get(value):
+            self.fail[value] -= 1
+            raise self.error(value)
+        self.rows.append(value)
+        return {"row": len(self.rows)}
+
+    async def already_applied(self, sheet_name, op, payload):
+        return payload["values"][0] in self.rows
+
+    def after_op(self, sheet_name, op, payload, result):
+        self.after.append((payload["values"][0], result))
+
+    def run(self, outbox):
+        return asyncio.run(outbox.apply_pending(self.apply, self.already_applied, self.after_op))
+
+
+def append(value):
+    return ("changes", "append", {"values": [value]})
+
+
+def statuses(outbox):
+    return outbox.db.execute("SELECT key, status, attempts FROM ops ORDER BY id").fetchall()
+
+
+def test_enqueue_is_idempotent_per_key(outbox):
+    assert outbox.enqueue("stock:1:10", [append("a"), append("b")])
+    assert not outbox.enqueue("stock:1:10", [append("a"), append("b")])
+    assert [json.loads(payload)["values"] for _, _, _, payload, _ in outbox.pending()] == [["a"], ["b"]]
+
+
+def test_apply_pending_keeps_order_and_updates_indexes(outbox):
+    sheets = Sheets()
+    outbox.enqueue("1", [append("a")])
+    outbox.enqueue("2", [append("b"), append("c")])
+    assert sheets.run(outbox)
+    assert sheets.rows == ["a", "b", "c"]
+    assert sheets.after == [("a", {"row": 1}), ("b", {"row": 2}), ("c", {"row": 3})]
+    assert not sheets.run(outbox)  # Очередь пуста
+
+
+def test_failed_op_holds_the_queue_until_retry(outbox):
+    sheets = Sheets(fail={"a": 1})
+    outbox.enqueue("1", [append("a")])
+    outbox.enqueue("2", [append("b")])
+    assert not sheets.run(outbox)
+    assert sheets.rows == []  # «b» не обогнала «a»
+    assert sheets.run(outbox)
+    assert sheets.rows == ["a", "b"]
+    assert outbox.metrics["outbox_applied"] == 2
+
+
+def test_replay_after_crash_does_not_append_twice(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    crashed = SheetsOutbox(path)
+    crashed.enqueue("1", [append("a")])
+    op_id = crashed.pending()[0][0]
+    crashed.start_attempt(op_id)  # Процесс упал после вызова API, но до finish
+    sheets = Sheets()
+    sheets.rows.append("a")  # Строка до таблицы дошла
+    crashed.db.close()
+
+    restarted = SheetsOutbox(path)
+    assert sheets.run(restarted)
+    assert sheets.rows == ["a"]
+    assert sheets.after == [("a", {})]
+    assert statuses(restarted) == [("1#0", "done", 1)]
+
+
+def test_replay_after_crash_repeats_op_that_did_not_reach_the_sheet(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    crashed = SheetsOutbox(path)
+    crashed.enqueue("1", [append("a")])
+    crashed.start_attempt(crashed.pending()[0][0])
+    crashed.db.close()
+
+    sheets = Sheets()
+    assert sheets.run(SheetsOutbox(path))
+    assert sheets.rows == ["a"]
+
+
+def test_missing_record_fails_without_blocking_the_queue(outbox):
+    sheets = Sheets(fail={"a": 1}, error=LookupError)
+    outbox.enqueue("1", [append("a")])
+    outbox.enqueue("2", [append("b")])
+    assert sheets.run(outbox)
+    assert sheets.rows == ["b"]
+    assert [status for _, status, _ in statuses(outbox)] == ["failed", "done"]
+
+
+def test_op_is_set_aside_after_max_attempts(outbox):
+    sheets = Sheets(fail={"a": 10})
+    outbox.enqueue("1", [append("a")])
+    outbox.enqueue("2", [append("b")])
+    while sheets.run(outbox) is False and outbox.pending():
+        pass
+    assert sheets.rows == ["b"]
+    assert statuses(outbox)[0] == ("1#0", "failed", 3)
+    assert outbox.metrics["outbox_failed"] == 1
+
+
+def test_take_new_returns_each_op_once_whatever_its_status(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = SheetsOutbox(path)
+    outbox.enqueue("1", [append("a")])
+    op_id = outbox.pending()[0][0]
+    outbox.finish(op_id, "failed", "ошибка API")
+    outbox.enqueue("2", [append("b")])
+    # Новый читатель начинает с первой неприменённой операции — записанная с ошибкой тоже новая
+    assert [payload["values"] for _, _, _, payload in outbox.take_new("detector")] == [["a"], ["b"]]
+    assert outbox.take_new("detector") == []
+    outbox.enqueue("3", [append("c")])
+    outbox.db.close()
+
+    restarted = SheetsOutbox(path)
+    assert [payload["values"] for _, _, _, payload in restarted.take_new("detector")] == [["c"]]
+
+
+def test_unknown_op_fails_without_retries(outbox):
+    sheets = Sheets(fail={"a": 1}, error=ValueError)
+    outbox.enqueue("1", [append("a")])
+    outbox.enqueue("2", [append("b")])
+    assert sheets.run(outbox)
+    assert statuses(outbox) == [("1#0", "failed", 1), ("2#0", "done", 1)]
@@ -0,0 +1,16 @@
+from types import SimpleNamespace
+
+from routing import callback_route
+
+
+def callback(data):
+    return SimpleNamespace(data=data)
+
+
+def test_callback_route_matches_exact_data_and_prefixes():
+    check = callback_route(exact={"admin_pending"}, prefixes=("pending_toggle:", "report:"))
+    assert check(callback("admin_pending"))
+    assert check(callback("pending_toggle:111"))
+    assert not check(callback("admin_pending_extra"))
+    assert not check(callback("car:info:1"))
+    assert not check(callback(None))  # У inline-кнопок игр callback_data нет
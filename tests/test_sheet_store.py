@@ -0,0 +1,204 @@
+import asyncio
+import logging
+from collections import Counter
+
+import pytest
+
+from fakes import FakeSpreadsheet, FakeWorksheet
+from sheet_store import CarIndex, RowMoved, UserIndex, a1_cell, checked_row_update, checked_rows_update
+
+USERS_HEADER = ["Телефон", "ФИО", "Дата", "Статус", "Telegram ID", "Состояние"]
+
+
+def make_users(*rows):
+    worksheet = FakeWorksheet("Пользователи", [USERS_HEADER, *rows])
+    return worksheet, UserIndex(worksheet, ttl=60), FakeSpreadsheet(worksheet)
+
+
+def locate(index):
+    """Как locate_user бота: карта строк без чтения листа, при промахе — перечитывание."""
+    def locate_user(telegram_id):
+        index.loaded_rows()
+        entry = index.by_id.get(str(telegram_id))
+        if entry is None and index.reload_if_older(0):
+            entry = index.by_id.get(str(telegram_id))
+        return entry
+    return locate_user
+
+
+def test_a1_cell():
+    assert a1_cell(3, 5) == "E3"
+    assert a1_cell(10, 27) == "AA10"
+
+
+def test_user_search_by_name_word_and_phone():
+    _, users, _ = make_users(
+        ["+79001112233", "Иванов Пётр Сергеевич", "", "Подтвержден", "111"],
+        ["+79004445566", "Петров Иван", "", "Ожидает", "222"],
+    )
+    assert [u[0] for u in users.search("пётр")] == ["111"]
+    assert [u[0] for u in users.search("Петров")] == ["222"]
+    assert [u[0] for u in users.search("8 900 444")] == ["222"]
+    assert users.search("   ") == []
+
+
+def test_car_search_matches_lookalike_letters_and_substrings():
+    worksheet = FakeWorksheet("Машины", [["Номер", "Остаток", "Дата"], ["А123ВС 77", "40", ""], ["K555OP", "10", ""]])
+    cars = CarIndex(worksheet, ttl=60)
+    assert cars.search("a123") == ["А123ВС 77"]  # Латиница находит кириллический номер
+    assert cars.search("23bc") == ["А123ВС 77"]
+    assert cars.search("к555") == ["K555OP"]
+    ids = dict(cars.car_ids)
+    worksheet.rows[1:] = reversed(worksheet.rows[1:])
+    cars.invalidate()
+    cars.get_rows()
+    assert cars.car_ids == ids  # ID не зависит от порядка строк
+
+
+def test_car_search_whole_plate_with_region_before_count():
+    worksheet = FakeWorksheet("Машины", [["Номер", "Остаток", "Дата"], ["А123ВС 77", "40", ""]])
+    cars = CarIndex(worksheet, ttl=60)
+    # /car_history ищет сначала всю строку: регион номера не принимается за количество
+    assert cars.search("А123ВС 77", limit=1) == ["А123ВС 77"]
+    assert cars.search("А123ВС 77 5", limit=1) == []
+
+
+def test_refresh_rereads_stale_cache_and_swaps_indexes():
+    worksheet = FakeWorksheet("Машины", [["Номер", "Остаток", "Дата"], ["А123ВС 77", "40", ""]])
+    cars = CarIndex(worksheet, ttl=60)
+    asyncio.run(cars.refresh())
+    by_number = cars.by_number
+    worksheet.rows.append(["K555OP", "10", ""])
+    asyncio.run(cars.refresh())
+    assert "K555OP" not in cars.by_number  # Кэш ещё свежий
+    cars.invalidate()
+    asyncio.run(cars.refresh())
+    assert "K555OP" in cars.by_number
+    assert "K555OP" not in by_number  # Прежний словарь не изменён, а заменён
+
+
+def test_patch_row_and_add_appended_update_cache_without_reading():
+    worksheet, users, _ = make_users(["+79001112233", "Иванов", "", "Ожидает", "111"])
+    users.get_rows()
+    users.patch_row(2, {3: "Подтвержден"})
+    assert users.by_id["111"][1][3] == "Подтвержден"
+
+    response = worksheet.append_row(["+79004445566", "Петров", "", "Ожидает", "222"])
+    users.add_appended(response, ["+79004445566", "Петров", "", "Ожидает", "222"])
+    assert users.by_id["222"][0] == 3
+    assert worksheet.reads == 1
+
+
+def test_reload_if_older_rereads_only_stale_cache():
+    worksheet, users, _ = make_users(["+79001112233", "Иванов", "", "Подтвержден", "111"])
+    users.loaded_rows()
+    worksheet.rows.append(["+79004445566", "Петров", "", "Подтвержден", "222"])
+    assert not users.reload_if_older(60)
+    assert "222" not in users.by_id
+    assert users.reload_if_older(0)
+    assert "222" in users.by_id
+
+
+def test_checked_row_update_writes_cached_row():
+    worksheet, users, spreadsheet = make_users(
+        ["+79001112233", "Иванов", "", "Подтвержден", "111", "Свободен"],
+        ["+79004445566", "Петров", "", "Подтвержден", "222", "Свободен"],
+    )
+    row = checked_row_update(spreadsheet, worksheet, users, locate(users), "222", 4, {5: "В рейсе"})
+    assert row == 3
+    assert worksheet.rows[2][5] == "В рейсе"
+    assert len(spreadsheet.requests) == 1  # Проверка адреса — в том же запросе
+
+
+def test_checked_row_update_restores_displaced_row_and_retries():
+    worksheet, users, spreadsheet = make_users(
+        ["+79001112233", "Иванов", "", "Подтвержден", "111", "Свободен"],
+        ["+79004445566", "Петров", "", "Подтвержден", "222", "Свободен"],
+    )
+    users.get_rows()
+    # Строку вставили вручную над Ивановым: кэш считает, что Петров всё ещё в строке 3
+    worksheet.rows.insert(1, ["+79007778899", "Сидоров", "", "Подтвержден", "333", "Свободен"])
+    metrics = Counter()
+
+    with pytest.raises(RowMoved):
+        checked_row_update(spreadsheet, worksheet, users, locate(users), "222", 4, {5: "В рейсе"}, metrics)
+    assert worksheet.rows[2] == ["+79001112233", "Иванов", "", "Подтвержден", "111", "Свободен"]
+    assert metrics["row_conflicts"] == 1
+
+    # Кэш сброшен — повтор из очереди находит новую строку
+    row = checked_row_update(spreadsheet, worksheet, users, locate(users), "222", 4, {5: "В рейсе"}, metrics)
+    assert row == 4
+    assert worksheet.rows[3][5] == "В рейсе"
+
+
+def test_checked_row_update_clears_cells_written_into_empty_row():
+    worksheet, users, spreadsheet = make_users(
+        ["+79001112233", "Иванов", "", "Подтвержден", "111", "Свободен"],
+        ["+79004445566", "Петров", "", "Подтвержден", "222", "Свободен"],
+    )
+    users.get_rows()
+    del worksheet.rows[1]  # Строку Иванова удалили — Петров поднялся на строку 2
+
+    with pytest.raises(RowMoved):
+        checked_row_update(spreadsheet, worksheet, users, locate(users), "222", 4, {5: "В рейсе"})
+    assert all(not value for value in worksheet.rows[2])
+
+
+def test_checked_row_update_unknown_key():
+    worksheet, users, spreadsheet = make_users(["+79001112233", "Иванов", "", "Подтвержден", "111"])
+    with pytest.raises(LookupError):
+        checked_row_update(spreadsheet, worksheet, users, locate(users), "999", 4, {5: "В рейсе"})
+    assert spreadsheet.requests == []
+
+
+def test_checked_rows_update_skips_rows_with_changed_status():
+    worksheet, users, spreadsheet = make_users(
+        ["+79001112233", "Иванов", "", "Ожидает", "111", ""],
+        ["+79004445566", "Петров", "", "Отклонено", "222", ""],
+    )
+    written = checked_rows_update(
+        spreadsheet, worksheet, users, locate(users), 4,
+        {"111": {3: "Подтвержден", 5: "Свободен"}, "222": {3: "Подтвержден", 5: "Свободен"}},
+        expect={3: "Ожидает"},
+    )
+    assert written == {"111": 2}
+    assert worksheet.rows[1][3] == "Подтвержден"
+    assert worksheet.rows[2][3] == "Отклонено"
+
+
+def test_row_unknown_to_cache_is_reported_not_restored_from_reread(caplog):
+    worksheet, users, spreadsheet = make_users(
+        ["+79001112233", "Иванов", "", "Ожидает", "111", ""],
+        ["+79004445566", "Петров", "", "Ожидает", "222", ""],
+    )
+    users.get_rows()
+    # Заявку вставили вручную на место Петрова: её нет в кэше
+    worksheet.rows.insert(2, ["+79007778899", "Сидоров", "", "Ожидает", "333", ""])
+
+    with caplog.at_level(logging.ERROR), pytest.raises(RowMoved):
+        checked_rows_update(
+            spreadsheet, worksheet, users, locate(users), 4,
+            {"222": {3: "Подтвержден", 5: "Свободен"}}, expect={3: "Ожидает"},
+        )
+    # Значения после перечитывания листа — записанные ботом, «восстанавливать» ими нельзя
+    assert len(spreadsheet.requests) == 1
+    assert "'333'" in caplog.text and "проверьте вручную" in caplog.text
+
+
+def test_row_moved_reports_rows_written_by_the_same_batch():
+    worksheet, users, spreadsheet = make_users(
+        ["+79001112233", "Иванов", "", "Ожидает", "111", ""],
+        ["+79004445566", "Петров", "", "Ожидает", "222", ""],
+        ["+79007778899", "Сидоров", "", "Ожидает", "333", ""],
+    )
+    users.get_rows()
+    worksheet.rows[2], worksheet.rows[3] = worksheet.rows[3], worksheet.rows[2]  # Петрова и Сидорова поменяли местами
+
+    with pytest.raises(RowMoved) as moved:
+        checked_rows_update(
+            spreadsheet, worksheet, users, locate(users), 4,
+            {"111": {3: "Подтвержден"}, "222": {3: "Подтвержден"}}, expect={3: "Ожидает"},
+        )
+    # Иванов записан, запись Петрова отменена: уведомлять можно только Иванова
+    assert moved.value.written == {"111": 2}
+    assert [row[3] for row in worksheet.rows[1:]] == ["Подтвержден", "Ожидает", "Ожидает"]
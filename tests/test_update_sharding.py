@@ -0,0 +1,38 @@
+import asyncio
+
+from update_sharding import process_in_chat_order, shard_index, update_shard_key
+
+
+def message(update_id, chat_id, text):
+    return {"update_id": update_id, "message": {"chat": {"id": chat_id}, "from": {"id": chat_id}, "text": text}}
+
+
+def test_shard_key_uses_chat_of_message_or_callback():
+    assert update_shard_key(message(1, 42, "")) == 42
+    callback = {"update_id": 2, "callback_query": {"from": {"id": 7}, "message": {"chat": {"id": 42}}}}
+    assert update_shard_key(callback) == 42
+    inline = {"update_id": 3, "inline_query": {"from": {"id": 7}, "query": ""}}
+    assert update_shard_key(inline) == 7
+    assert shard_index(message(4, 42, ""), 4) == 2
+
+
+def test_updates_of_one_chat_are_handled_in_order():
+    updates = [message(i, i % 3, str(i)) for i in range(30)]
+    pending = iter(updates)
+    handled = []
+
+    async def next_update():
+        return next(pending, None)
+
+    async def handle(update):
+        chat_id = update["message"]["chat"]["id"]
+        # Апдейты чата 0 обрабатываются дольше остальных, но не обгоняют друг друга
+        await asyncio.sleep(0.002 if chat_id == 0 else 0)
+        handled.append((chat_id, int(update["message"]["text"])))
+
+    asyncio.run(process_in_chat_order(next_update, handle))
+    assert len(handled) == len(updates)
+    for chat_id in range(3):
+        seqs = [seq for chat, seq in handled if chat == chat_id]
+        assert seqs == sorted(seqs)
+    assert handled.index((0, 0)) > 0  # Медленный чат не задерживал остальные
@@ -0,0 +1,60 @@
+"""Деление апдейтов Telegram между процессами-обработчиками и порядок внутри чата.
+
+Модуль не зависит от бота: его использует mashina_bot.py в режиме
+BOT_WORKERS > 1, а bench_sharding.py измеряет на нём пропускную способность.
+"""
+import asyncio
+
+
+def update_shard_key(update: dict) -> int:
+    """Чат, к которому относится апдейт: по нему апдейты делятся между процессами.
+
+    Все апдейты одного чата попадают в один процесс, так что порядок
+    и состояние FSM пользователя (при MemoryStorage) сохраняются.
+    """
+    for kind in ("message", "edited_message", "callback_query", "inline_query", "my_chat_member"):
+        event = update.get(kind)
+        if not event:
+            continue
+        message = event.get("message") if kind == "callback_query" else event
+        if message and "chat" in message:
+            return message["chat"]["id"]
+        return event["from"]["id"]
+    return 0
+
+
+def shard_index(update: dict, workers: int) -> int:
+    """Номер процесса-обработчика для апдейта."""
+    return update_shard_key(update) % workers
+
+
+async def process_in_chat_order(next_update, handle):
+    """Обрабатывает апдейты разных чатов параллельно, одного чата — по очереди.
+
+    next_update — корутина-функция, возвращающая очередной апдейт или None
+    (сигнал остановки); handle(update) — корутина обработки. Возвращает
+    управление, когда обработаны все полученные апдейты.
+    """
+    chat_tails = {}  # chat_id -> задача с последним апдейтом чата
+    tasks = set()
+
+    async def run(chat_id, update, previous):
+        if previous is not None:
+            await asyncio.wait([previous])  # Ошибка предыдущего апдейта не останавливает очередь
+        try:
+            await handle(update)
+        finally:
+            if chat_tails.get(chat_id) is asyncio.current_task():
+                del chat_tails[chat_id]
+
+    while True:
+        update = await next_update()
+        if update is None:
+            break
+        chat_id = update_shard_key(update)
+        task = asyncio.create_task(run(chat_id, update, chat_tails.get(chat_id)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        chat_tails[chat_id] = task
+    if tasks:
+        await asyncio.wait(list(tasks))